@@ -1,5 +1,46 @@
 
+import struct
+import sys
+from array import array
 from bisect import bisect_left
+from itertools import chain
+
+# widths that struct can read and write in one call
+_STRUCT_CODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+_UNPACK_FROM = {width: struct.Struct('<' + code).unpack_from for width, code in _STRUCT_CODES.items()}
+# other common widths (including the default of 6) are read as a low and a high int: width -> (unpacker, shift of the high int)
+_UNPACK_SPLIT_FROM = {3: (struct.Struct('<HB').unpack_from, 16), 5: (struct.Struct('<IB').unpack_from, 32),
+                      6: (struct.Struct('<IH').unpack_from, 32)}
+# the same, for two consecutive ints at once, as read for the (start, end) of a cell
+_UNPACK_PAIR_FROM = {width: struct.Struct('<2' + code).unpack_from for width, code in _STRUCT_CODES.items()}
+_UNPACK_SPLIT_PAIR_FROM = {3: (struct.Struct('<HBHB').unpack_from, 16), 5: (struct.Struct('<IBIB').unpack_from, 32),
+                           6: (struct.Struct('<IHIH').unpack_from, 32)}
+# (row length, byte width) -> struct packer for a whole row
+_row_packers = {}
+# (row length, byte width) -> function decoding a whole row from (buffer, offset), or None for widths struct can't read
+_row_unpackers = {}
+# up to this many ints, a row is decoded faster by one struct call than by unpack_ints' bulk conversion
+_ROW_UNPACK_MAX_INTS = 32
+
+
+def _row_unpacker(length, byte_width):
+    if byte_width in _STRUCT_CODES:
+        unpack_from = struct.Struct('<%d%s' % (length, _STRUCT_CODES[byte_width])).unpack_from
+        def unpack_row(buffer, offset):
+            return list(unpack_from(buffer, offset))
+    elif byte_width in _UNPACK_SPLIT_FROM:
+        # each int is read as a low and a high part, which are then recombined
+        split_codes = {3: 'HB', 5: 'IB', 6: 'IH'}[byte_width]
+        unpack_from = struct.Struct('<' + split_codes*length).unpack_from
+        shift = _UNPACK_SPLIT_FROM[byte_width][1]
+        def unpack_row(buffer, offset):
+            parts = iter(unpack_from(buffer, offset))
+            return [low | high << shift for low, high in zip(parts, parts)]
+    else:
+        unpack_row = None
+    _row_unpackers[length, byte_width] = unpack_row
+    return unpack_row
+
 class FDDIntList:
     def __init__(self, length, buffer, byte_width=6, start_in_buffer=0):
         self.length = length
@@ -8,15 +49,118 @@ class FDDIntList:
         self.start_in_buffer = start_in_buffer
 
     def __getitem__(self,idx):
-        if idx < 0:
+        # in range indices pass with a single comparison; negative indices are only handled off the fast path
+        if not 0 <= idx < self.length:
+            if not -self.length <= idx < 0:
+                raise IndexError('Index out of bounds', idx, self.length)
             idx = self.length + idx
-        if idx >= self.length or idx < 0:
-            raise IndexError('Index out of bounds', idx, self.length)
-        buf = self.buffer[self.start_in_buffer + idx*self.byte_width:self.start_in_buffer + (idx+1)*self.byte_width]
-        return int.from_bytes(buf, 'little')
+        start = self.start_in_buffer + idx*self.byte_width
+        unpack_from = _UNPACK_FROM.get(self.byte_width)
+        if unpack_from is not None:
+            return unpack_from(self.buffer, start)[0]
+        split = _UNPACK_SPLIT_FROM.get(self.byte_width)
+        if split is not None:
+            low, high = split[0](self.buffer, start)
+            return low | high << split[1]
+        return int.from_bytes(self.buffer[start:start + self.byte_width], 'little')
+
+    def span(self, idx):
+        # (self[idx], self[idx+1]), decoded with a single struct call where possible
+        if not 0 <= idx < self.length - 1:
+            return self[idx], self[idx+1]
+        start = self.start_in_buffer + idx*self.byte_width
+        unpack_from = _UNPACK_PAIR_FROM.get(self.byte_width)
+        if unpack_from is not None:
+            return unpack_from(self.buffer, start)
+        split = _UNPACK_SPLIT_PAIR_FROM.get(self.byte_width)
+        if split is not None:
+            low, high, next_low, next_high = split[0](self.buffer, start)
+            return low | high << split[1], next_low | next_high << split[1]
+        return self[idx], self[idx+1]
     
     def __len__(self):
         return self.length
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def tolist(self):
+        if self.length <= _ROW_UNPACK_MAX_INTS:
+            key = (self.length, self.byte_width)
+            unpack_row = _row_unpackers[key] if key in _row_unpackers else _row_unpacker(*key)
+            if unpack_row is not None:
+                try:
+                    return unpack_row(self.buffer, self.start_in_buffer)
+                except struct.error:
+                    pass # truncated buffer, handled below
+        packed = self.raw_bytes()
+        if len(packed) != self.length*self.byte_width:
+            # truncated buffer, let __getitem__ decode what is there
+            return [self[i] for i in range(self.length)]
+        return unpack_ints(packed, self.byte_width)
+
+    def raw_bytes(self):
+        # the packed little-endian representation, as stored in the parent buffer
+        return self.buffer[self.start_in_buffer:self.start_in_buffer + self.length*self.byte_width]
+
+
+def pack_ints(val, byte_width):
+    """
+    Packs a sequence of ints into little-endian fixed width bytes.
+    Rows that are already packed with the same width (e.g. taken from another index) are copied without decoding.
+    """
+    if isinstance(val, FDDIntList) and val.byte_width == byte_width:
+        return val.raw_bytes()
+    if byte_width in _STRUCT_CODES:
+        # one struct call for the whole row instead of a to_bytes call per int
+        if not isinstance(val, (tuple, list)):
+            val = tuple(val)
+        key = (len(val), byte_width)
+        pack = _row_packers.get(key)
+        if pack is None:
+            pack = _row_packers[key] = struct.Struct('<%d%s' % (len(val), _STRUCT_CODES[byte_width])).pack
+        try:
+            return pack(*val)
+        except struct.error as e:
+            raise OverflowError('int does not fit in byte_width', byte_width) from e
+    return b''.join([i.to_bytes(byte_width, 'little') for i in val])
+
+
+def unpack_ints(packed, byte_width):
+    """
+    Decodes little-endian fixed width bytes into a list of ints, the inverse of pack_ints.
+    Each int is widened to an 8 byte word with one extended slice assignment per byte, and the words are
+    then converted by array in C, instead of decoding the ints one by one.
+    """
+    count = len(packed) // byte_width
+    if sys.byteorder != 'little' or byte_width > 8:
+        return [int.from_bytes(packed[i*byte_width:(i+1)*byte_width], 'little') for i in range(count)]
+    if byte_width == 8:
+        words = bytearray(packed)
+    else:
+        words = bytearray(8*count)
+        for byte in range(byte_width):
+            words[byte::8] = packed[byte::byte_width]
+    return array('Q', words).tolist()
+
+
+def pack_rows(rows, byte_width):
+    """
+    Packs many rows of ints at once into one buffer of little-endian fixed width bytes.
+    The ints are converted to 8 byte words in C by array, and the high bytes of each word are then
+    removed with extended slice deletions, instead of calling to_bytes once per int.
+    """
+    rows = list(rows)
+    if sys.byteorder != 'little' or byte_width > 8 or all(isinstance(r, FDDIntList) and r.byte_width == byte_width for r in rows):
+        return b''.join([pack_ints(r, byte_width) for r in rows])
+    words = array('Q', chain.from_iterable(rows))
+    packed = bytearray(words.tobytes())
+    # an int fits if the high bytes of its word are zero, which count checks in C without decoding the words again
+    if any(packed[byte::8].count(0) != len(words) for byte in range(byte_width, 8)):
+        raise OverflowError('int too big to convert', max(words), byte_width)
+    for word_width in range(8, byte_width, -1):
+        del packed[word_width-1::word_width]
+    return packed
         
 
 class FDDIndexBase:
@@ -56,27 +200,64 @@ class FDDIndexKeyless(FDDIndexBase):
     
     def __setitem__(self, idx, val):
         if idx == len(self):
-            for i in val:
-                self.buffer.extend(i.to_bytes(self.byte_width, 'little'))
+            self.buffer.extend(pack_ints(val, self.byte_width))
         elif idx > len(self):
             raise IndexError('Index out of bounds', idx, len(self))
         else:
-            for i, v in enumerate(val):
-                self.buffer[idx*self.num_vals*self.byte_width + i*self.byte_width:idx*self.num_vals*self.byte_width + (i+1)*self.byte_width] = v.to_bytes(self.byte_width, 'little')
+            row_start = idx*self.num_vals*self.byte_width
+            self.buffer[row_start:row_start + self.num_vals*self.byte_width] = pack_ints(val, self.byte_width)
+
+    def extend(self, rows):
+        # appends many rows at once, packed in one pass
+        rows = list(rows)
+        wrong_lengths = set(map(len, rows)) - {self.num_vals}
+        if wrong_lengths:
+            raise ValueError('Incorrect length of val', wrong_lengths.pop(), self.num_vals)
+        self.buffer.extend(pack_rows(rows, self.byte_width))
+
+    def narrowest_byte_width(self):
+        # the fewest whole bytes that hold every int in the index. Offsets into files under 4GB fit in 4 bytes.
+        if not self.buffer:
+            return 1
+        return max(1, (max(unpack_ints(self.buffer, self.byte_width)).bit_length() + 7) // 8)
+
+    def repacked(self, byte_width):
+        # a copy of this index with every int stored in byte_width bytes
+        keyless = FDDIndexKeyless(self.num_vals, byte_width)
+        keyless.buffer = bytearray(pack_rows([unpack_ints(self.buffer, self.byte_width)], byte_width))
+        return keyless
+
+    def rows(self):
+        # every row decoded at once, as tuples of ints
+        return list(zip(*[iter(unpack_ints(self.buffer, self.byte_width))]*self.num_vals))
+
+    def packed_rows(self):
+        # every row as its packed bytes, which compare and hash like the rows they encode at this width
+        buffer = bytes(self.buffer)
+        row_bytes = self.num_vals*self.byte_width
+        return [buffer[i:i+row_bytes] for i in range(0, len(buffer), row_bytes)]
 
     def write_index_bytes(self,file):
+        # stored with the narrowest width that fits. The width is part of the header, so readers need no changes.
         import struct
-        file.write(struct.pack('<QQQ',self.__len__(), self.num_vals, self.byte_width))
-        file.write(self.buffer)
+        index = self
+        byte_width = self.narrowest_byte_width()
+        if byte_width < self.byte_width:
+            index = self.repacked(byte_width)
+        file.write(struct.pack('<QQQ',index.__len__(), index.num_vals, index.byte_width))
+        file.write(index.buffer)
 
 
 class FDDOnDiskIndex(FDDIndexBase):
+    # rows decoded per read when iterating
+    BLOCK_ROWS = 4096
+
     def __init__(self, parent, ptr_in_file):
         self.parent = parent
-        self.parent.file.seek(ptr_in_file)
-        self.len = int.from_bytes(self.parent.file.read(8), byteorder='little')
-        self.num_vals= int.from_bytes(self.parent.file.read(8), byteorder='little')
-        self.byte_width= int.from_bytes(self.parent.file.read(8), byteorder='little')
+        header = self.parent.read_chunk(ptr_in_file, ptr_in_file+8*3)
+        self.len = int.from_bytes(header[0:8], byteorder='little')
+        self.num_vals= int.from_bytes(header[8:16], byteorder='little')
+        self.byte_width= int.from_bytes(header[16:24], byteorder='little')
 
         assert(self.byte_width <= 16)
 
@@ -90,34 +271,44 @@ class FDDOnDiskIndex(FDDIndexBase):
         return range(len(self))
     
     def items(self):
-        for i in range(len(self)):
-            yield i, self[i]
+        return zip(range(len(self)), self._iter_rows())
 
     def values(self):
-        for i in range(len(self)):
-            yield self[i]
+        return self._iter_rows()
 
     def __contains__(self, key):
         return key < len(self) and key >= 0
     
     def __iter__(self):
-        for i in range(len(self)):
-            yield self[i]
+        return self._iter_rows()
+
+    def _iter_rows(self):
+        # rows are decoded a block at a time into tuples of ints, instead of wrapping each one in an FDDIntList
+        row_bytes = self.num_vals*self.byte_width
+        for first in range(0, self.len, self.BLOCK_ROWS):
+            last = min(self.len, first + self.BLOCK_ROWS)
+            packed = self.parent.read_chunk(self.ptr_in_file + first*row_bytes, self.ptr_in_file + last*row_bytes)
+            yield from zip(*[iter(unpack_ints(packed, self.byte_width))]*self.num_vals)
+
+    def rows(self):
+        # every row decoded at once, as tuples of ints
+        return self.get_keyless_index().rows()
 
     def __getitem__(self, idx):
-        if idx >= len(self) or idx < 0:
+        if not 0 <= idx < self.len:
             raise IndexError('Index out of bounds', idx, len(self))
         
-        self.parent.file.seek(self.ptr_in_file+idx*self.num_vals*self.byte_width)
-        buffer = self.parent.file.read(self.num_vals*self.byte_width)
+        start = self.ptr_in_file+idx*self.num_vals*self.byte_width
+        # the row is copied out rather than read from the parent's memory map in place, so that it stays valid
+        # after the parent is closed, like the rows of every other index
+        buffer = self.parent.read_chunk(start, start+self.num_vals*self.byte_width)
 
         return FDDIntList(self.num_vals, buffer, byte_width=self.byte_width, start_in_buffer=0)
     
     def get_keyless_index(self):
         
         keyless = FDDIndexKeyless(self.num_vals,self.byte_width)
-        self.parent.file.seek(self.ptr_in_file)
-        keyless.buffer = self.parent.file.read(len(self)*self.num_vals*self.byte_width)
+        keyless.buffer = self.parent.read_chunk(self.ptr_in_file, self.ptr_in_file+len(self)*self.num_vals*self.byte_width)
         return keyless
         
 
@@ -131,15 +322,18 @@ class FDDOnDiskIndex(FDDIndexBase):
             
 
 class FDDIndexComparableKey(FDDIndexBase):
-    def __init__(self, dict_index, byte_width=6):
-        self._keys = list(dict_index.keys())
+    def __init__(self, dict_index, byte_width=6, keys=None):
+        # keys selects a subset of dict_index, so a split can be built from the main index without copying it first
+        self._keys = list(dict_index.keys() if keys is None else keys)
         self._keys.sort()
         self.num_vals = len(dict_index[self._keys[0]])
-        self.buffer=bytearray()
         self.byte_width = byte_width
-        for k in self._keys:
-            for i in dict_index[k]:
-                self.buffer.extend(i.to_bytes(self.byte_width, 'little'))
+        # the whole buffer is packed in one pass, and kept as is instead of being copied into a fresh bytearray.
+        # Sorting the bare keys and looking the rows up again is faster than sorting (key, row) pairs,
+        # which compares through tuples and needs a pass to split the pairs apart afterwards.
+        self.buffer = pack_rows(map(dict_index.__getitem__, self._keys), self.byte_width)
+        if not isinstance(self.buffer, bytearray):
+            self.buffer = bytearray(self.buffer)
 
     def __getitem__(self, key):
         # idx = self.keys.index(key) #make it faster by doing a binary search
@@ -174,6 +368,73 @@ class FDDIndexComparableKey(FDDIndexBase):
     def __len__(self):
         return len(self._keys)
 
+class FDDIndexCompact(FDDIndexBase):
+    """
+    A read-only FDDIndexGeneral that keeps its keys in a list and finds them through an open-addressed hash table
+    stored in an array, instead of a dict that maps every key to a separate int object.
+    It uses about a third of the memory per key, and the table is a single object, so forked processes
+    (e.g. DataLoader workers) don't copy its pages by touching reference counts. Lookups are slower than a dict's.
+    """
+    def __init__(self, general):
+        self.num_vals = general.num_vals
+        self.byte_width = general.byte_width
+        self.buffer = general.buffer
+        # rows are numbered in insertion order, so the keys list doubles as the row -> key mapping
+        self._keys = [None]*len(general.index)
+        for key, row in general.index.items():
+            self._keys[row] = key
+        capacity = 1
+        while capacity < 2*len(self._keys):
+            capacity *= 2
+        self._mask = capacity - 1
+        # row + 1 of the key hashed to each slot, 0 for an empty slot
+        self._table = array('q', bytes(8*capacity))
+        for row, key in enumerate(self._keys):
+            slot = hash(key) & self._mask
+            while self._table[slot]:
+                slot = (slot + 1) & self._mask
+            self._table[slot] = row + 1
+
+    def _row(self, key):
+        # linear probe until the key or an empty slot is found, -1 if the key is missing
+        table, keys, mask = self._table, self._keys, self._mask
+        slot = hash(key) & mask
+        while True:
+            row = table[slot] - 1
+            if row < 0 or keys[row] == key:
+                return row
+            slot = (slot + 1) & mask
+
+    def __getitem__(self, key):
+        row = self._row(key)
+        if row < 0:
+            raise KeyError(key)
+        return FDDIntList(self.num_vals, self.buffer, byte_width=self.byte_width, start_in_buffer=row*self.num_vals*self.byte_width)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        return self._keys
+
+    def items(self):
+        for k, v in zip(self._keys, self.values()):
+            yield k, v
+
+    def values(self):
+        for i in range(len(self._keys)):
+            yield FDDIntList(self.num_vals, self.buffer, byte_width=self.byte_width, start_in_buffer=i*self.num_vals*self.byte_width)
+
+    def __contains__(self, key):
+        try:
+            return self._row(key) >= 0
+        except TypeError:
+            # unhashable
+            return False
+
+    def __iter__(self):
+        return self.values()
+
 class FDDIndexGeneral(FDDIndexBase):
     def __init__(self, num_vals, byte_width=6):
         self.num_vals = num_vals
@@ -193,21 +454,33 @@ class FDDIndexGeneral(FDDIndexBase):
             raise ValueError('Incorrect length of val', len(val), self.num_vals)
 
 
-        if key not in self.index:
+        row = self.index.get(key)
+        if row is None:
+            # pack before adding the key, so a value that does not fit leaves the index unchanged
+            self.buffer += pack_ints(val, self.byte_width)
             self.index[key] = len(self.index)
-            for i in val:
-                self.buffer.extend(i.to_bytes(self.byte_width, 'little'))
         else:
-            idx = self.index[key]
-            for i, v in enumerate(val):
-                self.buffer[idx*self.num_vals*self.byte_width + i*self.byte_width:idx*self.num_vals*self.byte_width + (i+1)*self.byte_width] = v.to_bytes(self.byte_width, 'little')
+            row_start = row*self.num_vals*self.byte_width
+            self.buffer[row_start:row_start + self.num_vals*self.byte_width] = pack_ints(val, self.byte_width)
     
     def __len__(self):
         return len(self.index)
     
     def update(self, dict_index):
-        for k in dict_index:
-            self[k] = dict_index[k]
+        # rows for existing keys are overwritten one by one, and rows for new keys are checked, packed in one pass
+        # and appended with a single extend
+        new_keys = []
+        for k in dict_index.keys():
+            if k in self.index:
+                self[k] = dict_index[k]
+            else:
+                new_keys.append(k)
+        rows = [dict_index[k] for k in new_keys]
+        wrong_lengths = set(map(len, rows)) - {self.num_vals}
+        if wrong_lengths:
+            raise ValueError('Incorrect length of val', wrong_lengths.pop(), self.num_vals)
+        self.buffer.extend(pack_rows(rows, self.byte_width))
+        self.index.update(zip(new_keys, range(len(self.index), len(self.index) + len(new_keys))))
     
     def keys(self):
         return self.index.keys()
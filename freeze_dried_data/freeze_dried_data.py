@@ -1,47 +1,237 @@
 import pickle as pkl
 import os
-from typing import Any, Dict, Iterator, Tuple, Optional, Union, List, Iterable
+import gc
+import io
+import marshal
+import mmap
+from typing import Any, Dict, Iterator, Tuple, Optional, Union, List, Iterable, Sequence
 import sys
+import sqlite3
+import struct
+import threading
+import time
 import warnings
 import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
 
 
 try:
-    from .efficient_index import FDDIndexKeyless, FDDIndexComparableKey, FDDIntList, FDDIndexGeneral, FDDIndexBase,FDDOnDiskIndex
+    from .efficient_index import FDDIndexKeyless, FDDIndexComparableKey, FDDIntList, FDDIndexGeneral, FDDIndexBase,FDDOnDiskIndex, FDDIndexCompact, unpack_ints
 except ImportError:
-    from efficient_index import FDDIndexKeyless, FDDIndexComparableKey, FDDIntList, FDDIndexGeneral, FDDIndexBase,FDDOnDiskIndex
+    from efficient_index import FDDIndexKeyless, FDDIndexComparableKey, FDDIntList, FDDIndexGeneral, FDDIndexBase,FDDOnDiskIndex, FDDIndexCompact, unpack_ints
 
 
 
 
+# Protocol 5 (PEP 574) lets buffer-backed objects such as numpy arrays hand their memory
+# to the pickler directly instead of first copying it into an intermediate bytes object.
+_pkl_dumps = partial(pkl.dumps, protocol=5)
 
+# below this many bytes per row, handing columns to threads costs more than it saves
+_PARALLEL_DESERIALIZE_MIN_BYTES = 1 << 16
+# below this many bytes per row, flushing the write buffer for a copy_file_range costs more than it saves
+_KERNEL_COPY_MIN_BYTES = 1 << 16
+# below this many bytes per cell, copying the cell out of the memory map is as cheap as taking a view of it
+_ZERO_COPY_MIN_BYTES = 1 << 12
+# WFDD only appends, so rows are gathered into large writes instead of the default 8 KiB ones
+_WRITE_BUFFER_BYTES = 1 << 20
+
+def _pkl_dumps_unmemoized(obj: Any) -> bytes:
+    """
+    Pickles obj without memoizing anything, giving the same stream as pickletools.optimize(_pkl_dumps(obj)).
+    Meant for indices, which are acyclic and have no meaningful shared references. Anything that references
+    itself, such as an unusual key, can't be pickled this way, and is pickled with _pkl_dumps instead.
+    """
+    buffer = io.BytesIO()
+    pickler = pkl.Pickler(buffer, protocol=5)
+    pickler.fast = True
+    try:
+        pickler.dump(obj)
+    except (RecursionError, ValueError):
+        # fast mode gives up on cycles with a ValueError, or runs out of stack on deep ones
+        return _pkl_dumps(obj)
+    return buffer.getvalue()
+
+def _numpy_serialize(x: Any) -> bytes:
+    """
+    Serializes a numpy array as a small header (dtype and shape) followed by the raw C-ordered array data.
+    """
+    import numpy as np
+    x = np.asarray(x, order='C')
+    if x.dtype.hasobject or x.dtype.fields is not None:
+        raise ValueError("The 'numpy' column type only supports plain numeric dtypes, use 'any' instead.", x.dtype)
+    dtype = x.dtype.str.encode('ascii')
+    header = struct.pack('<BB', len(dtype), x.ndim) + dtype + struct.pack(f'<{x.ndim}Q', *x.shape)
+    return b''.join((header, x.data))
+
+def _numpy_deserialize(x: bytes) -> Any:
+    """
+    Deserializes an array written by _numpy_serialize. The array is a read-only view of x, no data is copied.
+    """
+    import numpy as np
+    dtype_length, ndim = x[0], x[1]
+    dtype = np.dtype(bytes(x[2:2+dtype_length]).decode('ascii'))
+    data_start = 2 + dtype_length + 8*ndim
+    shape = struct.unpack(f'<{ndim}Q', x[2+dtype_length:data_start])
+    if len(x) == data_start:
+        return np.empty(shape, dtype)
+    return np.frombuffer(x, dtype=dtype, offset=data_start).reshape(shape)
+
+def _torch_serialize(x: Any, channels_last: bool = False) -> bytes:
+    """
+    Serializes a tensor in the same layout as _numpy_serialize, but with the torch dtype name,
+    so that dtypes numpy does not have (such as bfloat16) are stored as raw data too.
+
+    :param channels_last: Store a 4d NCHW tensor's data in NHWC order. The shape in the header stays NCHW.
+    """
+    import torch
+    x = x.detach().cpu()
+    if channels_last:
+        # in channels_last memory the NHWC permutation is contiguous, so flattening it below copies nothing more
+        data = x.contiguous(memory_format=torch.channels_last).permute(0, 2, 3, 1)
+    else:
+        data = x.contiguous()
+    dtype = str(x.dtype)[len('torch.'):].encode('ascii')
+    header = struct.pack('<BB', len(dtype), x.dim()) + dtype + struct.pack(f'<{x.dim()}Q', *x.shape)
+    return b''.join((header, data.reshape(-1).view(torch.uint8).numpy()))
+
+def _torch_deserialize(x: bytes, channels_last: bool = False) -> Any:
+    """
+    Deserializes a tensor written by _torch_serialize. The tensor uses the memory of x, no data is copied.
+    With channels_last, the tensor is NCHW with channels_last strides, as if .to(memory_format=torch.channels_last) had been called.
+    """
+    import torch
+    dtype_length, ndim = x[0], x[1]
+    dtype = getattr(torch, bytes(x[2:2+dtype_length]).decode('ascii'), None)
+    if not isinstance(dtype, torch.dtype):
+        raise ValueError("Not a torch dtype.", bytes(x[2:2+dtype_length]))
+    data_start = 2 + dtype_length + 8*ndim
+    shape = struct.unpack(f'<{ndim}Q', x[2+dtype_length:data_start])
+    if len(x) == data_start:
+        return torch.empty(shape, dtype=dtype, memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+    tensor = torch.frombuffer(x, dtype=dtype, offset=data_start)
+    if channels_last:
+        n, c, h, w = shape
+        return tensor.reshape(n, h, w, c).permute(0, 3, 1, 2)
+    return tensor.reshape(shape)
+
+# the compression libraries below are imported on first use, so that each is only needed for files that use it.
+# zstandard contexts are kept for reuse, one per thread because they are not thread safe (rows can be deserialized
+# on the deserialize pool).
+_zstd_contexts = threading.local()
+
+def _zstd_compress(data: bytes) -> bytes:
+    compressor = getattr(_zstd_contexts, 'compressor', None)
+    if compressor is None:
+        import zstandard
+        compressor = _zstd_contexts.compressor = zstandard.ZstdCompressor(level=3)
+    return compressor.compress(data)
+
+def _zstd_decompress(data: bytes) -> bytes:
+    decompressor = getattr(_zstd_contexts, 'decompressor', None)
+    if decompressor is None:
+        import zstandard
+        decompressor = _zstd_contexts.decompressor = zstandard.ZstdDecompressor()
+    return decompressor.decompress(data)
+
+def _lz4_compress(data: bytes) -> bytes:
+    # lz4 block functions keep no state between calls, so unlike zstandard there is no context to reuse
+    import lz4.block
+    return lz4.block.compress(data)
+
+def _lz4_decompress(data: bytes) -> bytes:
+    import lz4.block
+    return lz4.block.decompress(data)
+
+# fixed width int cells, and the index length at the end of the file, are packed by precompiled structs
+# rather than int.to_bytes/from_bytes
+_UINT64 = struct.Struct('<Q')
+_UINT32 = struct.Struct('<I')
+_UINT16 = struct.Struct('<H')
+_UINT8 = struct.Struct('<B')
+
+def _int_serializer(packer: struct.Struct) -> callable:
+    """
+    Returns the serializer of a fixed width int column. Ints that don't fit raise OverflowError,
+    as int.to_bytes does, rather than struct.error.
+    """
+    pack = packer.pack
+    byte_width = packer.size
+    def serialize(x: int) -> bytes:
+        try:
+            return pack(x)
+        except struct.error as e:
+            raise OverflowError('int does not fit in byte_width', byte_width) from e
+    return serialize
+
+def _identity(x: bytes) -> bytes:
+    # the (de)serializer of 'bytes' columns. Row reads check for it and skip the call, as bytes cells are stored as is
+    return x
+
+# str cells use the unbound C methods directly (both default to utf-8), saving a Python frame per cell
 type_to_serializer = {
-    'any': pkl.dumps,
-    'str': lambda x: x.encode('utf-8'),
+    'any': _pkl_dumps,
+    'str': str.encode,
     'str_compressed': lambda x: zlib.compress(x.encode('utf-8')),
-    'bytes': lambda x: x,
+    'str_zstd': lambda x: _zstd_compress(x.encode('utf-8')),
+    'str_lz4': lambda x: _lz4_compress(x.encode('utf-8')),
+    'bytes': _identity,
     'int128': lambda x: x.to_bytes(16, 'little'),
-.    'int64': lambda x: x.to_bytes(8, 'little'),
-    'int': lambda x: x.to_bytes(8, 'little'),
-    'int32': lambda x: x.to_bytes(4, 'little'),
-    'int16': lambda x: x.to_bytes(2, 'little'),
-    'int8': lambda x: x.to_bytes(1, 'little'),
+    'int64': _int_serializer(_UINT64),
+    'int': _int_serializer(_UINT64),
+    'int32': _int_serializer(_UINT32),
+    'int16': _int_serializer(_UINT16),
+    'int8': _int_serializer(_UINT8),
+    'numpy': _numpy_serialize,
+    'torch': _torch_serialize,
+    'torch_channels_last': partial(_torch_serialize, channels_last=True),
 }
 
 type_to_deserializer = {
     'any': pkl.loads,
-    'str': lambda x: x.decode('utf-8'),
+    'str': bytes.decode,
     'str_compressed': lambda x: zlib.decompress(x).decode('utf-8'),
-    'bytes': lambda x: x,
+    'str_zstd': lambda x: _zstd_decompress(x).decode('utf-8'),
+    'str_lz4': lambda x: _lz4_decompress(x).decode('utf-8'),
+    'bytes': _identity,
     'int128': lambda x: int.from_bytes(x, 'little'),
-    'int64': lambda x: int.from_bytes(x, 'little'),
-    'int': lambda x: int.from_bytes(x, 'little'),
-    'int32': lambda x: int.from_bytes(x, 'little'),
-    'int16': lambda x: int.from_bytes(x, 'little'),
-    'int8': lambda x: int.from_bytes(x, 'little'),
+    'int64': lambda x, unpack_from=_UINT64.unpack_from: unpack_from(x)[0],
+    'int': lambda x, unpack_from=_UINT64.unpack_from: unpack_from(x)[0],
+    'int32': lambda x, unpack_from=_UINT32.unpack_from: unpack_from(x)[0],
+    'int16': lambda x, unpack_from=_UINT16.unpack_from: unpack_from(x)[0],
+    'int8': lambda x, unpack_from=_UINT8.unpack_from: unpack_from(x)[0],
+    'numpy': _numpy_deserialize,
+    'torch': _torch_deserialize,
+    'torch_channels_last': partial(_torch_deserialize, channels_last=True),
 }
 
+# deserializers that accept any buffer and keep no reference to it, so they can read cells straight out of the
+# memory map. numpy arrays would keep the map exported (it could not be closed) and str needs bytes.decode.
+_BUFFER_DESERIALIZERS = frozenset(type_to_deserializer[t] for t in ['any', 'str_compressed', 'str_zstd', 'int128', 'int64', 'int', 'int32', 'int16', 'int8'])
+# numpy dtypes of the fixed width int columns, by deserializer, for reading a whole column at once
+_INT_COLUMN_DTYPES = {type_to_deserializer[t]: dtype for t, dtype in [('int64', '<u8'), ('int', '<u8'), ('int32', '<u4'), ('int16', '<u2'), ('int8', '<u1')]}
+
+
+def _column_codecs(column_def: Dict[str, Any]) -> Tuple[tuple, tuple]:
+    """
+    Resolves a column definition to its serializers and deserializers, one per column in order.
+    A column type is either the name of a built-in type or a (serialize, deserialize) pair.
+
+    :return: (column_to_serialize, column_to_deserialize)
+    """
+    serializers = []
+    deserializers = []
+    for t in column_def.values():
+        if isinstance(t, str):
+            serializers.append(type_to_serializer[t])
+            deserializers.append(type_to_deserializer[t])
+        else:
+            serializers.append(t[0])
+            deserializers.append(t[1])
+    return tuple(serializers), tuple(deserializers)
+
 class BaseFDD:
     """
     Base class for freeze-dried data. Should not be instantiated directly.
@@ -49,10 +239,35 @@ class BaseFDD:
 
     :param filename: The name of the file.
     """
+    disk_cache = None
+    deserialize_pool = None
+    _deserialize_pool_pid = None
 
     def __init__(self, filename: str) -> None:
         self.filename = filename
 
+    def get_deserialize_pool(self) -> ThreadPoolExecutor:
+        """
+        :return: The thread pool used to deserialize the columns of a row in parallel. Created on first use.
+        """
+        pid = os.getpid()
+        if self.deserialize_pool is None or self._deserialize_pool_pid != pid:
+            # the worker threads of a pool created before a fork do not exist in the child
+            num_columns = len(self.columns) if self.columns is not None else 1
+            self.__dict__['deserialize_pool'] = ThreadPoolExecutor(max_workers=max(1, min(num_columns, os.cpu_count() or 1)))
+            self.__dict__['_deserialize_pool_pid'] = pid
+        return self.deserialize_pool
+
+    def deserialize_chunk(self, start: int, end: int, deserialize: callable) -> Any:
+        """
+        Reads a chunk of data from the file and deserializes it.
+
+        :param start: The start position of the chunk.
+        :param end: The end position of the chunk.
+        :param deserialize: The function to deserialize the data with.
+        """
+        return deserialize(self.read_chunk(start, end))
+
     def __len__(self) -> int:
         return len(self.index)
     
@@ -63,24 +278,82 @@ class BaseFDD:
         return self.index.keys()
     
     def __iter__(self):
+        return self._iter_items()
+
+    def _iter_items(self, reuse_row: bool = False, prefetch: int = 0) -> Iterator[Tuple[Any, 'FDDReadRow']]:
         for k in self.keys():
             yield k, self[k]
 
-    def items(self) -> Iterator[Tuple[Any, 'FDDReadRow']]:
-        """ Yield (key, value) pairs, with length awareness for tqdm compatibility. """
+    def items(self, reuse_row: bool = False, prefetch: int = 0) -> Iterator[Tuple[Any, 'FDDReadRow']]:
+        """
+        Yield (key, value) pairs, with length awareness for tqdm compatibility.
+
+        :param reuse_row: Yield the same FDDReadRow object for every row, pointed at the next row on each step.
+            Saves an allocation per row when rows are not kept past the loop body.
+        :param prefetch: Ask the OS to start reading this many rows at a time ahead of the loop, see iter_prefetch.
+            Only used when reading from a memory-mapped file.
+        """
         class ItemsWithLength:
             def __init__(self, parent):
                 self.parent = parent
 
             def __iter__(self):
-                for k in self.parent.keys():
-                    yield k, self.parent[k]
+                return self.parent._iter_items(reuse_row, prefetch)
 
             def __len__(self):
                 return len(self.parent.index)
 
         return ItemsWithLength(self)
-    
+
+    def modify_cells(self, cells: Iterable[Tuple[Any, str, Any]]) -> None:
+        """
+        Overwrites many cells in place, as assigning to a column of a row does when allow_cell_modification is set.
+        The writes are made in file order, and cells that sit next to each other on disk go out in a single write.
+
+        :param cells: (key, column, value) triples.
+        :raises AttributeError: If cell modification is not allowed or a column is not found.
+        :raises ValueError: If a new value is not the same size as the data it replaces. Nothing is written then.
+        """
+        if not self.allow_cell_modification:
+            raise AttributeError("Cell modification is not allowed.")
+        if self.columns is None:
+            raise ValueError("Cells can only be modified in a file with columns.")
+        index = self.index
+        positions = _column_positions(self.columns)
+        serializers = self.column_to_serialize
+        writes = []
+        for key, name, value in cells:
+            position = positions.get(name)
+            if position is None:
+                raise AttributeError(f"Column not found: {name}")
+            row_index = index[key]
+            existing_start = row_index[position]
+            existing_end = row_index[position+1]
+            value_bytes = serializers[position](value)
+            if len(value_bytes) != existing_end-existing_start:
+                raise ValueError("The new cell data must be the same size as the data in the cell it's replacing. Existing size,", existing_end-existing_start, "New size,", len(value_bytes))
+            writes.append((existing_start, existing_end, value_bytes))
+
+        # sorted is stable, so if a cell is given twice the later value is written last
+        run_start = run_end = None
+        run = []
+        for start, end, value_bytes in sorted(writes, key=lambda write: write[0]):
+            if start != run_end:
+                if run:
+                    _write_at(self.file, run_start, b''.join(run))
+                run_start = start
+                run = []
+            run.append(value_bytes)
+            run_end = end
+        if run:
+            _write_at(self.file, run_start, b''.join(run))
+        if self.disk_cache is not None:
+            for start, _, _ in writes:
+                self.disk_cache.forget(start)
+        if getattr(self, 'read_row_cache', None) is not None:
+            # the cached rows may hold values read before the write
+            self._forget_read_rows()
+
     def __delattr__(self, name: str) -> None:
         """
         Deletes the custom property with the specified name.
@@ -91,6 +364,7 @@ class BaseFDD:
             del self.custom_properties[name]
             if hasattr(self, 'custom_properties_cache') and name in self.custom_properties_cache:
                 del self.custom_properties_cache[name]
+            self.__dict__.pop(name, None)
         else:
             super().__delattr__(name)
 
@@ -111,25 +385,297 @@ class BaseFDD:
         self.close()
     
     def close(self) -> None:
+        if self.deserialize_pool is not None:
+            self.deserialize_pool.shutdown()
+            self.deserialize_pool = None
         if not self.file.closed:
             self.file.close()
 
 
 
+def _write_at(file: io.BufferedRandom, offset: int, data: bytes) -> None:
+    """
+    Overwrites bytes of file at offset, leaving the file position alone.
+    Uses one positioned write where available. That goes straight to the file, so memory maps of it see the change
+    at once, but anything still buffered in file is flushed first so that it can't overwrite the new bytes later.
+    """
+    file.flush()
+    if hasattr(os, 'pwrite'):
+        os.pwrite(file.fileno(), data, offset)
+        return
+    position = file.tell()
+    file.seek(offset)
+    file.write(data)
+    file.flush()
+    file.seek(position)
+
+
+def _physical_memory() -> int:
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return sys.maxsize
+
+
+# compressed index blobs start with one of these instead of the b'\x80' that starts every pickle
+_ZLIB_INDEX_MAGIC = b'FDDz'
+_ZSTD_INDEX_MAGIC = b'FDDZ'
+_INDEX_MAGIC_TO_COMPRESSION = {_ZLIB_INDEX_MAGIC: 'zlib', _ZSTD_INDEX_MAGIC: 'zstd'}
+
+
+def _compress_index(data: bytes, compression: str) -> bytes:
+    if compression == 'zlib':
+        return _ZLIB_INDEX_MAGIC + zlib.compress(data, 1)
+    import zstandard
+    return _ZSTD_INDEX_MAGIC + zstandard.ZstdCompressor(level=1).compress(data)
+
+
+def _load_index(data: bytes, system_deserialize: callable) -> Any:
+    """
+    Decompresses an index blob if needed, and deserializes it with the garbage collector paused.
+    Indices allocate one container per row, which would otherwise trigger many collections that find nothing to free.
+    """
+    magic = data[:4]
+    if magic == _ZLIB_INDEX_MAGIC:
+        data = zlib.decompress(data[4:])
+    elif magic == _ZSTD_INDEX_MAGIC:
+        import zstandard
+        data = zstandard.ZstdDecompressor().decompress(data[4:])
+    if not gc.isenabled():
+        return system_deserialize(data)
+    gc.disable()
+    try:
+        return system_deserialize(data)
+    finally:
+        gc.enable()
+
+
+@lru_cache(maxsize=128)
+def _compile_filter(filter_func_str: str) -> callable:
+    """
+    Compiles the filter of a 'split$filter' spec into a function of the row. Specs tend to be opened over and over
+    (e.g. once per DataLoader worker or per epoch), so each is compiled only once.
+    """
+    return eval('lambda r:' + filter_func_str)
+
+
+def _widen_keyless(index: FDDIndexKeyless) -> FDDIndexKeyless:
+    """
+    Keyless indices are stored in the narrowest width that fits their offsets.
+    Rows appended after a reopen can lie past those offsets, so an index that is written to again gets the default width back.
+    """
+    default_width = FDDIndexKeyless(index.num_vals).byte_width
+    if index.byte_width >= default_width:
+        return index
+    return index.repacked(default_width)
+
+
+def _marshal_index(index: FDDIndexBase) -> bytes:
+    """
+    Serializes a keyed split index with marshal, which loads several times faster than pickle.
+    Raises ValueError for indices whose keys marshal cannot represent.
+    """
+    if isinstance(index, FDDIndexGeneral):
+        return marshal.dumps(('general', index.num_vals, index.byte_width, index.index, bytes(index.buffer)))
+    if isinstance(index, FDDIndexComparableKey):
+        return marshal.dumps(('comparable', index.num_vals, index.byte_width, index._keys, bytes(index.buffer)))
+    raise ValueError('Index type cannot be marshalled', type(index))
+
+
+def _unmarshal_index(data: bytes) -> FDDIndexBase:
+    kind, num_vals, byte_width, keys, buffer = marshal.loads(data)
+    if kind == 'general':
+        index = FDDIndexGeneral(num_vals, byte_width)
+        index.index = keys
+    else:
+        index = FDDIndexComparableKey.__new__(FDDIndexComparableKey)
+        index.num_vals = num_vals
+        index.byte_width = byte_width
+        index._keys = keys
+    index.buffer = bytearray(buffer)
+    return index
+
+
+class _HeaderReader:
+    """
+    Serves read_chunk from a single read of a region of a file, so that everything stored in the region
+    (such as the splits and properties at the end of an FDD) costs one read instead of one per item.
+
+    :param data: The bytes of the region.
+    :param start: The position of the region in the file.
+    """
+    def __init__(self, data: bytes, start: int) -> None:
+        self.data = data
+        self.start = start
+
+    def read_chunk(self, start: int, end: int) -> bytes:
+        return self.data[start - self.start:end - self.start]
+
+
+# values a disk cache gathers before writing them out in one transaction
+_DISK_CACHE_BATCH = 64
+
+
+class FDDDiskCache:
+    """
+    Persistent cache of deserialized values, stored in SQLite so that it is shared between processes and survives restarts.
+    Useful when deserialization is expensive (e.g. decompression or image decoding) and the same data is read again and again.
+    Values are keyed by their position in the source file, which is identified by path, size and modification time,
+    so rewriting the file never serves stale values, and the values cached for its earlier contents are dropped.
+    Least recently used entries are evicted beyond max_entries.
+    New values are written in batches, so they reach other processes once a batch is full or the cache is closed.
+
+    :param cache_path: The SQLite database to use. It is created if it does not exist.
+    :param source_filename: The FDD file whose values are cached.
+    :param max_entries: The number of values kept for source_filename.
+    """
+    def __init__(self, cache_path: str, source_filename: str, max_entries: int = 100000) -> None:
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        stat = os.stat(source_filename)
+        path = os.path.abspath(source_filename)
+        self.source = f'{path}:{stat.st_size}:{stat.st_mtime_ns}'
+        self.puts_since_eviction = 0
+        self._connect()
+        # sources of the same path sort between path + ':' and path + ';'
+        self._try(self.connection.execute, 'DELETE FROM fdd_cache WHERE source > ? AND source < ? AND source != ?',
+                  (path + ':', path + ';', self.source))
+
+    def _connect(self) -> None:
+        self.pid = os.getpid()
+        # values not written yet, and the last use of cached values, both by position
+        self.pending = {}
+        self.used = {}
+        self.connection = sqlite3.connect(self.cache_path, timeout=30, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # a lost batch only costs loading those values again, so commits don't wait for the disk
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS fdd_cache '
+                                '(source TEXT, position INTEGER, value BLOB, last_used INTEGER, PRIMARY KEY (source, position))')
+
+    def get_or_load(self, position: int, load: callable, dumps: callable = _pkl_dumps, loads: callable = pkl.loads) -> Any:
+        """
+        Returns the cached value stored for position, or calls load() and caches its result.
+
+        :param position: The position in the source file of the data being deserialized.
+        :param load: Function that reads and deserializes the data.
+        :param dumps: The function used to store values in the cache.
+        :param loads: The function used to read values from the cache.
+        """
+        if self.pid != os.getpid():
+            # SQLite connections must not be shared with the parent process
+            self._connect()
+        if position in self.pending:
+            return loads(self.pending[position])
+        row = self.connection.execute('SELECT value FROM fdd_cache WHERE source=? AND position=?', (self.source, position)).fetchone()
+        if row is not None:
+            self.used[position] = time.time_ns()
+            if len(self.used) >= _DISK_CACHE_BATCH:
+                self.flush()
+            return loads(row[0])
+
+        value = load()
+        try:
+            self.pending[position] = dumps(value)
+        except (pkl.PicklingError, TypeError, AttributeError):
+            # values that can't be pickled are simply not cached
+            return value
+        if len(self.pending) >= _DISK_CACHE_BATCH:
+            self.flush()
+        return value
+
+    def forget(self, position: int) -> None:
+        """
+        Drops the value cached for position, for data that was overwritten in place.
+        Unlike filling the cache, this is not best effort, as a value left behind would be stale.
+
+        :param position: The position in the source file of the overwritten data.
+        """
+        if self.pid != os.getpid():
+            self._connect()
+        self.pending.pop(position, None)
+        self.used.pop(position, None)
+        self.connection.execute('DELETE FROM fdd_cache WHERE source=? AND position=?', (self.source, position))
+
+    def flush(self) -> None:
+        """
+        Writes the pending values and last uses in one transaction, and evicts the least recently used entries.
+        """
+        pending, self.pending = self.pending, {}
+        used, self.used = self.used, {}
+        if pending or used:
+            self._try(self._write, pending, used)
+
+    def _write(self, pending: Dict[int, bytes], used: Dict[int, int]) -> None:
+        now = time.time_ns()
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('INSERT OR REPLACE INTO fdd_cache VALUES (?, ?, ?, ?)',
+                                        [(self.source, position, value, now) for position, value in pending.items()])
+            self.connection.executemany('UPDATE fdd_cache SET last_used=? WHERE source=? AND position=?',
+                                        [(last_used, self.source, position) for position, last_used in used.items()])
+            self.puts_since_eviction += len(pending)
+            if self.puts_since_eviction >= max(1, self.max_entries // 100):
+                self.puts_since_eviction = 0
+                self.connection.execute('DELETE FROM fdd_cache WHERE source=? AND position IN '
+                                        '(SELECT position FROM fdd_cache WHERE source=? ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                                        (self.source, self.source, self.max_entries))
+
+    def _try(self, function: callable, *args) -> None:
+        # the cache is best effort: lock contention between processes is not an error
+        try:
+            function(*args)
+        except sqlite3.Error:
+            pass
+
+    def close(self) -> None:
+        if self.pid == os.getpid():
+            self.flush()
+        self.connection.close()
+
+    def __getstate__(self) -> object:
+        state = self.__dict__.copy()
+        state.pop('connection')
+        # the values not written yet are left to this process
+        state.pop('pending')
+        state.pop('used')
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._connect()
+
+
 class RFDDImpl(BaseFDD):
     """
     RFDD (Freeze Dried Data Reader) class for reading freeze-dried data files.
 
     :param filename: The path to the freeze-dried data file.
     :param split: The split name to load, defaults to the all rows split.
+    :param allow_cell_modification: Open the file for writing too, so that cells can be overwritten in place
+        with values of the same size.
     :param system_deserialize: The function to use for deserializing the index, splits, and columns.
-        one function for each column.
+    :param cache_path: Optional SQLite file in which deserialized rows, cells, custom properties and split indices are cached across runs.
+        See FDDDiskCache.
+    :param lazy_splits: Defer loading the split index until it is first used.
+        Opening is then nearly free for programs that only read custom properties.
+    :param read_row_reuse: Return the same FDDReadRow from every rfdd[key], pointed at the new row on each call.
+        Saves allocating a row per lookup, but a row is only valid until the next lookup.
+    :param random_access: Tell the OS that rows will be read in random order (e.g. shuffled training), so that a
+        lookup faults in only the pages of its row instead of reading ahead. Full passes still read ahead while they run.
+    :param read_row_cache_size: How many of the most recently used rows rfdd[key] keeps, along with the values
+        loaded from them. Looking a kept row up again returns it as is. Not used with read_row_reuse.
     """
     def __init__(self,
                  filename: str,
                  split: str = 'all_rows',
                  allow_cell_modification: bool = False,
-                 system_deserialize: callable = pkl.loads) -> None:
+                 system_deserialize: callable = pkl.loads,
+                 cache_path: Optional[str] = None,
+                 lazy_splits: bool = False,
+                 read_row_reuse: bool = False,
+                 random_access: bool = False,
+                 read_row_cache_size: int = 1) -> None:
         
 
 
@@ -137,10 +683,7 @@ class RFDDImpl(BaseFDD):
             filename, split = filename.split('^')
         super().__init__(filename)
         self.allow_cell_modification = allow_cell_modification
-        if allow_cell_modification:
-            self.file = open(filename, 'rb+')
-        else:
-            self.file = open(filename, 'rb')
+        self._open_file()
         self.system_deserialize = system_deserialize
         self.no_columns_deserialize = pkl.loads
         self.column_to_deserialize = None
@@ -148,25 +691,47 @@ class RFDDImpl(BaseFDD):
         self.custom_properties_cache = {}
         self.read_row_cache = None
         self.cashed_read_row_key = None
+        self.read_row_reuse = read_row_reuse
+        self.read_row_cache_size = read_row_cache_size
+        self.random_access = random_access
+        # key -> row of the most recently used rows, oldest first. Only kept for caches of more than one row,
+        # as the single row case is covered by read_row_cache
+        self._read_rows = {} if read_row_cache_size > 1 and not read_row_reuse else None
+        # the madvise hint for the rows outside of full passes
+        self._rows_advice = getattr(mmap, 'MADV_RANDOM', None) if random_access else getattr(mmap, 'MADV_NORMAL', None)
+
+        if cache_path is not None:
+            self.disk_cache = FDDDiskCache(cache_path, filename)
 
-        self.load_indices(split)
-        os.register_at_fork(after_in_child=self._after_fork)
+        self.load_indices(split, lazy_splits)
+        if random_access:
+            self._advise([(0, self._rows_end)], self._rows_advice)
 
-    def _after_fork(self) -> None:
+    def _open_file(self) -> None:
         """
-        Reopen the file after a fork to prevent race conditions
-        if the object is cloned to another process. For example when using PyTorch DataLoader.
+        Opens the file and maps it into memory. Reads are served from the map,
+        so they cost neither a syscall nor a seek of the shared file position.
+        Both stay valid in processes forked from this one, for example DataLoader workers,
+        so nothing has to be reopened after a fork.
         """
-        self.file.close()
-        self.file = open(self.filename, 'rb+')
+        self.file = open(self.filename, 'rb+' if self.allow_cell_modification else 'rb')
+        self._mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
 
     def __getstate__(self) -> object:
         """
         Returns the state of the object for pickling.
-        the file object is removed because it cannot be pickled.
+        the file object and memory map are removed because they cannot be pickled.
         """
         state = self.__dict__.copy()
         state.pop('file')
+        state.pop('_mm')
+        # generated row classes are rebuilt on unpickling rather than pickled by reference
+        state.pop('_row_class')
+        state.pop('deserialize_pool', None)
+        state['read_row_cache'] = None
+        state['cashed_read_row_key'] = None
+        if state['_read_rows'] is not None:
+            state['_read_rows'] = {}
         return state
     
     def __setstate__(self, state: Dict[str, Any]) -> None:
@@ -175,7 +740,10 @@ class RFDDImpl(BaseFDD):
         The file object is reopened.
         """
         self.__dict__.update(state)
-        self.file = open(self.filename, 'rb+')
+        self._row_class = _row_class_for(self.columns) if self.columns is not None else None
+        self._open_file()
+        if self._rows_advice != getattr(mmap, 'MADV_NORMAL', None):
+            self._advise([(0, self._rows_end)], self._rows_advice)
 
     def __getitem__(self, key: Any) -> Union['FDDReadRow', Any]:
         """
@@ -185,38 +753,280 @@ class RFDDImpl(BaseFDD):
         :return: The row with the specified key. 
         :raises KeyError: If the key is not found.
         """
-        
-        if key not in self.index:
+        # self.index is a property (splits may load lazily), so it is looked up once
+        index = self.index
+        if key not in index:
             if isinstance(key, tuple):
-                if key[0] in self.index:
-                    indices = self.index[key[0]]
+                if key[0] in index:
+                    indices = index[key[0]]
                     col_index = self.columns[key[1]]
                     start = indices[col_index]
                     end = indices[col_index+1]
-                    data = self.read_chunk(start, end)
-                    return self.column_to_deserialize[col_index](data)
+                    return self.deserialize_chunk(start, end, self.column_to_deserialize[col_index])
             else:
-                if len(self.index.keys()) < 50:
-                    raise KeyError("Key not found.", key, self.index.keys())
+                # small indices list their keys in the error, large ones only their size
+                num_keys = len(index)
+                if num_keys < 50:
+                    raise KeyError("Key not found.", key, list(index.keys()))
                 else:
-                    raise KeyError("Key not found.", key, len(self.index.keys()))
+                    raise KeyError("Key not found.", key, num_keys)
 
         
         if self.columns is None:
-            
-            start, end = self.index[key]
-            data = self.read_chunk(start, end)
-
-            return self.no_columns_deserialize(data)
+            row_index = index[key]
+            start, end = row_index.span(0) if type(row_index) is FDDIntList else row_index
+            return self.deserialize_chunk(start, end, self.no_columns_deserialize)
         
         if self.read_row_cache is not None and key == self.cashed_read_row_key:
             return self.read_row_cache
         
-        read_row = FDDReadRow(self.index[key], self)
-        self.read_row_cache = read_row
+        read_rows = self._read_rows
+        if read_rows is not None:
+            # dicts keep insertion order, so moving a row to the end on each use leaves the least recently used first
+            read_row = read_rows.pop(key, None)
+            if read_row is None:
+                read_row = self._row_class(index[key], self)
+                if len(read_rows) >= self.read_row_cache_size:
+                    del read_rows[next(iter(read_rows))]
+            read_rows[key] = read_row
+            self.read_row_cache = read_row
+            self.cashed_read_row_key = key
+            return read_row
+
+        read_row = self.read_row_cache
+        if self.read_row_reuse and read_row is not None:
+            read_row._fdd_row_reset(index[key])
+        else:
+            read_row = self._row_class(index[key], self)
+            self.read_row_cache = read_row
         self.cashed_read_row_key = key
         return read_row
 
+    def getmany(self, keys: Iterable[Any]) -> List[Union['FDDReadRow', Any]]:
+        """
+        Gets the rows with the specified keys.
+        Without columns, the values are read in file order so the reads sweep forward through the file.
+
+        :param keys: The keys of the rows.
+        :return: The rows, in the same order as keys.
+        :raises KeyError: If a key is not found.
+        """
+        keys = list(keys)
+        if self.columns is not None:
+            return [self[k] for k in keys]
+
+        index = self.index
+        spans = []
+        for k in keys:
+            if k not in index:
+                raise KeyError("Key not found.", k)
+            row_index = index[k]
+            spans.append(row_index.span(0) if type(row_index) is FDDIntList else tuple(row_index))
+
+        values = [None] * len(keys)
+        for i in sorted(range(len(keys)), key=lambda i: spans[i][0]):
+            values[i] = self.deserialize_chunk(*spans[i], self.no_columns_deserialize)
+        return values
+
+    def column_array(self, column: str, keys: Optional[Iterable[Any]] = None) -> Any:
+        """
+        Reads a fixed width int column of many rows into a numpy array.
+        The cells are gathered out of the memory map and decoded by numpy in one step, instead of one Python int per cell.
+
+        :param column: The name of an int8, int16, int32, int64 or int column.
+        :param keys: The keys of the rows, defaults to all rows in index order.
+        :return: A 1d array of unsigned ints, in the order of keys.
+        :raises KeyError: If the column or a key is not found.
+        :raises ValueError: If the column is not a fixed width int column, or a row has no value in it.
+        """
+        import numpy as np
+        if self.columns is None or column not in self.columns:
+            raise KeyError("Column not found.", column)
+        position = self.columns[column]
+        dtype = _INT_COLUMN_DTYPES.get(self.column_to_deserialize[position])
+        if dtype is None:
+            raise ValueError("Only fixed width int columns can be read as an array.", column)
+
+        index = self.index
+        if keys is None and type(index) is FDDOnDiskIndex:
+            index = index.get_keyless_index()
+        if keys is None and type(index) in (FDDIndexKeyless, FDDIndexGeneral, FDDIndexComparableKey):
+            # these keep their rows packed in one buffer, in the order of their keys, so all of it is decoded at once
+            offsets = unpack_ints(index.buffer, index.byte_width)
+            spans = np.array(offsets, dtype=np.int64).reshape(-1, index.num_vals)[:, position:position+2]
+        else:
+            rows = map(index.__getitem__, index.keys() if keys is None else keys)
+            spans = np.array([(row[position], row[position+1]) for row in rows], dtype=np.int64).reshape(-1, 2)
+        starts = spans[:, 0]
+        width = np.dtype(dtype).itemsize
+        if (spans[:, 1] - starts != width).any():
+            raise ValueError("Every row needs a value in the column.", column)
+
+        data = np.frombuffer(self._mm, dtype=np.uint8)
+        try:
+            cells = data[starts[:, None] + np.arange(width)]
+        finally:
+            # the gathered cells are a copy; dropping the view of the map lets close() unmap it
+            del data
+        return cells.view(dtype).reshape(-1)
+
+    def iter_prefetch(self, keys: Optional[Iterable[Any]] = None, depth: int = 256) -> Iterator[Tuple[Any, Union['FDDReadRow', Any]]]:
+        """
+        Yields (key, row) pairs, asking the OS to start reading each batch of rows before it is consumed.
+        The reads of a batch are then in flight together instead of one page fault at a time.
+
+        :param keys: The keys to iterate over, defaults to all keys.
+        :param depth: The number of rows requested from the OS at once.
+        """
+        if keys is None:
+            keys = self.keys()
+        batch = []
+        for key in keys:
+            batch.append(key)
+            if len(batch) == depth:
+                yield from self._iter_prefetched_batch(batch)
+                batch = []
+        yield from self._iter_prefetched_batch(batch)
+
+    def _iter_prefetched_batch(self, keys: List[Any]) -> Iterator[Tuple[Any, Union['FDDReadRow', Any]]]:
+        self._advise_rows(map(self.index.__getitem__, keys))
+        for k in keys:
+            yield k, self[k]
+
+    def _advise_rows(self, row_indices: Iterable[Sequence[int]]) -> None:
+        ranges = []
+        for row in row_indices:
+            ranges.append((row[0], row[len(row)-1]))
+        self._advise(ranges, getattr(mmap, 'MADV_WILLNEED', None))
+
+    def _prefetched(self, index_items: Iterable[Tuple[Any, Sequence[int]]], depth: int) -> Iterator[Tuple[Any, Sequence[int]]]:
+        # same batching as iter_prefetch, but over (key, row index) pairs that are already at hand
+        batch = []
+        for item in index_items:
+            batch.append(item)
+            if len(batch) == depth:
+                self._advise_rows([row_index for _, row_index in batch])
+                yield from batch
+                batch = []
+        self._advise_rows([row_index for _, row_index in batch])
+        yield from batch
+
+    def _iter_items(self, reuse_row: bool = False, prefetch: int = 0) -> Iterator[Tuple[Any, Union['FDDReadRow', Any]]]:
+        if self.columns is None:
+            # rows are read in full anyway, so let the OS fetch them ahead of time
+            return self._iter_sequential(self.iter_prefetch(depth=prefetch or 256))
+        return self._iter_sequential(self._iter_rows(reuse_row, prefetch))
+
+    def _iter_sequential(self, items: Iterator[Tuple[Any, Any]]) -> Iterator[Tuple[Any, Any]]:
+        # a full pass reads the rows in file order, so ask for aggressive readahead while it runs
+        rows = [(0, self._rows_end)]
+        self._advise(rows, getattr(mmap, 'MADV_SEQUENTIAL', None))
+        try:
+            yield from items
+        finally:
+            if not self._mm.closed:
+                self._advise(rows, self._rows_advice)
+                if self._rows_end > _physical_memory() and hasattr(os, 'posix_fadvise'):
+                    # the rows can't all stay cached anyway, so free the page cache for other data
+                    os.posix_fadvise(self.file.fileno(), 0, self._rows_end, os.POSIX_FADV_DONTNEED)
+
+    def _iter_rows(self, reuse_row: bool, prefetch: int = 0) -> Iterator[Tuple[Any, 'FDDReadRow']]:
+        # walks the index directly instead of looking every key up again through __getitem__
+        row_class = self._row_class
+        index_items = self.index.items()
+        if prefetch > 0:
+            index_items = self._prefetched(index_items, prefetch)
+        if not reuse_row:
+            for k, row_index in index_items:
+                yield k, row_class(row_index, self)
+            return
+
+        row = None
+        for k, row_index in index_items:
+            if row is None:
+                row = row_class(row_index, self)
+            else:
+                row._fdd_row_reset(row_index)
+            yield k, row
+
+    def iterate(self, prefetch_bytes: int = 64 << 20) -> Iterator[Tuple[Any, Union['FDDReadRow', Any]]]:
+        """
+        Yields (key, row) pairs like items(), but reads the rows in slabs of up to prefetch_bytes with one read each,
+        and deserializes every row in full from its slab. Consecutive rows of a file are usually stored back to back,
+        so on spinning disks and network filesystems this replaces many small reads with a few large ones.
+
+        :param prefetch_bytes: The most bytes read at once. Rows bigger than this are read on their own.
+        """
+        if self.disk_cache is not None:
+            # rows come out of the cache, not the file
+            yield from self.items()
+            return
+        fadvise = getattr(os, 'posix_fadvise', None)
+        if fadvise is not None:
+            fadvise(self.file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        try:
+            group = []
+            group_start = group_end = 0
+            for key, row_index in self.index.items():
+                row_index = tuple(row_index)
+                start, end = row_index[0], row_index[-1]
+                if group and not (group_start <= start <= group_end and end - group_start <= prefetch_bytes):
+                    yield from self._iter_slab(group, group_start, group_end)
+                    group = []
+                if not group:
+                    group_start, group_end = start, end
+                group.append((key, row_index))
+                group_end = max(group_end, end)
+            yield from self._iter_slab(group, group_start, group_end)
+        finally:
+            # the hint covers the whole file and outlives the pass, so put back the one for lookups,
+            # as _iter_sequential does for the memory map
+            if fadvise is not None and not self.file.closed:
+                fadvise(self.file.fileno(), 0, 0, os.POSIX_FADV_RANDOM if self.random_access else os.POSIX_FADV_NORMAL)
+
+    def _iter_slab(self, group: List[Tuple[Any, Sequence[int]]], start: int, end: int) -> Iterator[Tuple[Any, Union['FDDReadRow', Any]]]:
+        if not group:
+            return
+        if hasattr(os, 'pread'):
+            slab = os.pread(self.file.fileno(), end - start, start)
+        else:
+            slab = self._mm[start:end]
+        if self.columns is None:
+            deserialize = self.no_columns_deserialize
+            for key, (row_start, row_end) in group:
+                yield key, deserialize(slab[row_start-start:row_end-start])
+            return
+        row_class = self._row_class
+        for key, row_index in group:
+            row = row_class(row_index, self)
+            row._fdd_row_materialize(False, slab, start)
+            yield key, row
+
+    def _advise(self, ranges: Iterable[Tuple[int, int]], advice: Optional[int]) -> None:
+        """
+        Passes an madvise hint for byte ranges of the file, merging neighbouring ranges into a single call.
+        Does nothing if the platform does not support the hint.
+
+        :param ranges: (start, end) byte ranges of the file.
+        :param advice: One of the mmap.MADV_* constants, or None.
+        """
+        if advice is None or not hasattr(self._mm, 'madvise'):
+            return
+        page_size = mmap.PAGESIZE
+        merged_start = merged_end = None
+        for start, end in sorted(ranges):
+            if start >= end:
+                continue
+            start -= start % page_size
+            if merged_end is not None and start <= merged_end:
+                merged_end = max(merged_end, end)
+                continue
+            if merged_end is not None:
+                self._mm.madvise(advice, merged_start, merged_end - merged_start)
+            merged_start, merged_end = start, end
+        if merged_end is not None:
+            self._mm.madvise(advice, merged_start, merged_end - merged_start)
+
     def read_chunk(self, start: int, end: int) -> bytes:
         """
         Reads a chunk of data from the file.
@@ -226,35 +1036,64 @@ class RFDDImpl(BaseFDD):
         :return: The data read from the file.
         :rtype: bytes
         """
-        self.file.seek(start)
-        return self.file.read(end - start)
+        return self._mm[start:end]
+
+    def deserialize_chunk(self, start: int, end: int, deserialize: callable) -> Any:
+        """
+        Reads a chunk of data from the file and deserializes it, going through the disk cache if there is one.
+
+        :param start: The start position of the chunk.
+        :param end: The end position of the chunk.
+        :param deserialize: The function to deserialize the data with.
+        """
+        if self.disk_cache is None:
+            return self._deserialize_span(start, end, deserialize)
+        return self.disk_cache.get_or_load(start, lambda: self._deserialize_span(start, end, deserialize))
+
+    def _deserialize_span(self, start: int, end: int, deserialize: callable) -> Any:
+        if end - start >= _ZERO_COPY_MIN_BYTES and deserialize in _BUFFER_DESERIALIZERS:
+            # the view is released before returning, so close() can still unmap the file
+            with memoryview(self._mm)[start:end] as view:
+                return deserialize(view)
+        return deserialize(self._mm[start:end])
+
+    def close(self) -> None:
+        if not self._mm.closed:
+            self._mm.close()
+        if self.disk_cache is not None:
+            self.disk_cache.close()
+        super().close()
     
     def _get_split_object(self, split: str) -> FDDIndexBase:
         if split in self.split_to_index:
             start, end = self.split_to_index[split]
 
             
-            self.file.seek(start)
-            byte = self.file.read(1)
-            if byte==b'\01': # this is a keyless split
+            if self._mm[start] == 1: # this is a keyless split
                 return FDDOnDiskIndex(self,start+1)
+            elif self.disk_cache is not None:
+                return self.disk_cache.get_or_load(start, lambda: _load_index(self.read_chunk(start, end), self.system_deserialize),
+                                                   dumps=_marshal_index, loads=_unmarshal_index)
             else:
-                return self.system_deserialize(self.read_chunk(start, end))
+                return _load_index(self.read_chunk(start, end), self.system_deserialize)
 
 
         else:
             raise KeyError("Split not found.", split)
         
-    def load_keys(self, row_to_key: callable, filter_function: callable=lambda x:True) -> None:
+    def load_keys(self, row_to_key: callable, filter_function: callable=lambda x:True, prefetch: int = 0) -> None:
         """
         Compute keys of each row and set index to reflect computed keys
 
         :param row_to_key: Function used to compute keys
         :param filter_function: Function to filter. The function takes an FDDReadRow and returns a boolean (true if the row should be kept)
+        :param prefetch: The number of rows the OS is asked to read ahead at once, see items().
         """
         new_index = FDDIndexGeneral(self.index.num_vals, self.index.byte_width)
 
-        for k,v in self:
+        # the kept rows are collected first and packed into the new index in one pass
+        kept = {}
+        for k,v in self.items(prefetch=prefetch):
             if not filter_function(v):
                 continue
             if row_to_key:
@@ -262,30 +1101,49 @@ class RFDDImpl(BaseFDD):
             else:
                 new_key = k
 
-            if new_key in new_index:
+            if new_key in kept:
                 warnings.warn(f'redundant key computed by row_to_key {new_key}, new value:{v}. Skipping new row.')
             else:
-                new_index[new_key]=self.index[k]
+                kept[new_key]=self.index[k]
 
+        new_index.update(kept)
         self.index = new_index
+        self._forget_read_rows()
 
-    def filter(self, filter_function: callable, row_to_key: callable=None) -> None:
+    def filter(self, filter_function: callable, row_to_key: callable=None, prefetch: int = 0) -> None:
 
         """
         Filter rows of an FDD. Optionally also load keys using the given function.
 
         :param filter_function: Function to filter. The function takes an FDDReadRow and returns a boolean (true if the row should be kept)
         :param row_to_key: Function used to compute keys
+        :param prefetch: The number of rows the OS is asked to read ahead at once, see items().
+        """
+        self.load_keys(row_to_key, filter_function, prefetch)
+
+    def compact_index(self) -> None:
+        """
+        Replaces a dict based index (FDDIndexGeneral) with an FDDIndexCompact, which uses about a third of the memory per key
+        at the cost of somewhat slower lookups. Calling it before forking DataLoader workers also stops the workers from
+        copying the index pages. Other kinds of index are left as they are.
         """
-        self.load_keys(row_to_key, filter_function)
+        if isinstance(self.index, FDDIndexGeneral):
+            self.index = FDDIndexCompact(self.index)
 
         
+    def _forget_read_rows(self) -> None:
+        # rows are cached by key, so they are dropped whenever a key may come to mean another row
+        self.read_row_cache = None
+        if self._read_rows is not None:
+            self._read_rows.clear()
+
     def load_new_split(self, split: str) -> None:
         """
         Loads a new split from the file.
 
         :param split: The name of the split to load.
         """
+        self._forget_read_rows()
         filter_func_str = None
         if '$' in split:
             split, filter_func_str = split.split('$')
@@ -301,22 +1159,26 @@ class RFDDImpl(BaseFDD):
             if isinstance(split_objects[0],FDDIndexComparableKey):
                 dct = {}
                 for s in split_objects:
-                    for k,v in s.items():
-                        dct[k] = v
+                    dct.update(s.items())
                 self.index = FDDIndexComparableKey(dct)
             elif isinstance(split_objects[0], FDDIndexGeneral):
                 self.index = split_objects[0]
                 for s in split_objects[1:]:
-                    for k,v in s.items():
-                        self.index[k] = v
+                    # new keys are packed and appended in bulk
+                    self.index.update(s)
             elif isinstance(split_objects[0], FDDIndexKeyless) or isinstance(split_objects[0], FDDOnDiskIndex):
+                # splits are stored as narrow as their own offsets allow, so use the widest of them
+                byte_width = max(s.byte_width for s in split_objects)
+                # rows are deduplicated as packed bytes, so only splits of other widths are decoded (to be repacked)
                 rows = {}
                 for s in split_objects:
-                    for v in s.values():
-                        rows[tuple([i for i in v])] = True
-                self.index = FDDIndexKeyless(split_objects[0].num_vals, split_objects[0].byte_width)
-                for i,r in enumerate(rows.keys()):
-                    self.index[i] = r
+                    if isinstance(s, FDDOnDiskIndex):
+                        s = s.get_keyless_index()
+                    if s.byte_width != byte_width:
+                        s = s.repacked(byte_width)
+                    rows.update(dict.fromkeys(s.packed_rows()))
+                self.index = FDDIndexKeyless(split_objects[0].num_vals, byte_width)
+                self.index.buffer = bytearray(b''.join(rows))
             else:
                 raise ValueError('split type',type(split_objects[0]),'not found')
             
@@ -325,9 +1187,7 @@ class RFDDImpl(BaseFDD):
             self.index = self._get_split_object(split)
 
         if filter_func_str:
-            filter_func_str = 'lambda r:' + filter_func_str
-            filter_func = eval(filter_func_str)
-            self.filter(filter_func)
+            self.filter(_compile_filter(filter_func_str))
 
     def get_available_splits(self) -> List[str]:
         """
@@ -336,18 +1196,30 @@ class RFDDImpl(BaseFDD):
         return list(self.split_to_index.keys())
         
 
-    def load_indices(self, split: str = 'all_rows') -> None:
+    @property
+    def index(self) -> FDDIndexBase:
+        if self._index is None:
+            self.load_new_split(self._pending_split)
+        return self._index
+
+    @index.setter
+    def index(self, index: FDDIndexBase) -> None:
+        self._index = index
+
+    def load_indices(self, split: str = 'all_rows', lazy_splits: bool = False) -> None:
         """
         Reads from the end of the file loading custom properties, columns, and the split index.
 
         :param split: The split to load, defaults to 
+        :param lazy_splits: Only remember the split, and load its index when it is first used.
         """
-        self.file.seek(-8, 2)
-        index_index_size = int.from_bytes(self.file.read(8), 'little')
+        file_size = len(self._mm)
+        index_index_size, = _UINT64.unpack_from(self._mm, file_size - 8)
 
-        self.file.seek(-(8 + index_index_size), 2)
-        index_index_data = self.file.read(index_index_size)
-        index_index = self.system_deserialize(index_index_data)
+        index_index_data = self.read_chunk(file_size - 8 - index_index_size, file_size - 8)
+        index_index = _load_index(index_index_data, self.system_deserialize)
+        # the rows are written first, everything in index_index comes after them
+        self._rows_end = min((start for start, _ in index_index.values()), default=file_size - 8 - index_index_size)
         
         self.split_to_index = {k[7:]:v for k,v in index_index.items() if k.startswith('_split_')}
         
@@ -366,6 +1238,7 @@ class RFDDImpl(BaseFDD):
             self.columns = self.system_deserialize(self.read_chunk(columns_start, columns_end))
             if self.columns is not None:
                 self.columns = {n: i for i, n in enumerate(self.columns)}
+        self._row_class = _row_class_for(self.columns) if self.columns is not None else None
         
         if '_column_def_' in index_index:
             column_def_start, column_def_end = index_index['_column_def_']
@@ -376,16 +1249,16 @@ class RFDDImpl(BaseFDD):
                 import dill
                 self.column_def = dill.loads(self.read_chunk(column_def_start, column_def_end))
 
-            self.column_to_deserialize = {v: type_to_deserializer[t] if isinstance(t, str) else t[1] for v, t in self.column_def.items()}   
-            self.column_to_deserialize = tuple(self.column_to_deserialize.values())
-            self.column_to_serialize = {v: type_to_serializer[t] if isinstance(t, str) else t[0] for v, t in self.column_def.items()}   
-            self.column_to_serialize = tuple(self.column_to_serialize.values())
+            self.column_to_serialize, self.column_to_deserialize = _column_codecs(self.column_def)
                 
         
 
         self.custom_properties = {k[6:]:v for k,v in index_index.items() if k.startswith('_prop_')}
 
-        self.load_new_split(split)
+        self._index = None
+        self._pending_split = split
+        if not lazy_splits:
+            self.load_new_split(split)
 
 
 
@@ -400,9 +1273,11 @@ class RFDDImpl(BaseFDD):
         if name in self.custom_properties_cache:
             return self.custom_properties_cache[name]
         if name in self.custom_properties:
-            bytes = self.read_chunk(*self.custom_properties[name])
-            loaded_prop = self.system_deserialize(bytes) 
+            loaded_prop = self.deserialize_chunk(*self.custom_properties[name], self.system_deserialize)
             self.custom_properties_cache[name] = loaded_prop
+            # __getattr__ only runs when normal lookup fails, so this shadows nothing, and later reads of the
+            # property are served from the instance dict without coming back here
+            self.__dict__[name] = loaded_prop
             return loaded_prop
         else:
             return super().__getattr__(name)
@@ -415,9 +1290,16 @@ class RFDDCombined:
                  filename: str,
                  split: str,
                  allow_cell_modification = False,
-                 system_deserialize: callable = pkl.loads) -> None:
+                 system_deserialize: callable = pkl.loads,
+                 cache_path: Optional[str] = None,
+                 lazy_splits: bool = False,
+                 read_row_reuse: bool = False,
+                 random_access: bool = False,
+                 read_row_cache_size: int = 1) -> None:
         self.rfdds = [
-                RFDDImpl(i, split, allow_cell_modification=allow_cell_modification,system_deserialize=system_deserialize)
+                RFDDImpl(i, split, allow_cell_modification=allow_cell_modification,system_deserialize=system_deserialize,
+                         cache_path=cache_path, lazy_splits=lazy_splits, read_row_reuse=read_row_reuse,
+                         random_access=random_access, read_row_cache_size=read_row_cache_size)
             for i in filename.split(',')]
 
         which_are_keyless = [isinstance(i.index,FDDOnDiskIndex) or isinstance(i.index,FDDIndexKeyless) for i in self.rfdds]
@@ -508,15 +1390,6 @@ class RFDDCombined:
         for rfdd in self.rfdds:
             rfdd.close()
 
-    def _after_fork(self) -> None:
-        """
-        Reopen the file after a fork to prevent race conditions
-        if the object is cloned to another process. For example when using PyTorch DataLoader.
-        """
-        for rfdd in self.rfdds:
-            rfdd.file.close()
-            rfdd.file = open(rfdd.filename, 'rb+')
-
     def __getstate__(self) -> object:
         """
         Returns the state of the object for pickling.
@@ -560,28 +1433,37 @@ class RFDDCombined:
                     return rfdd[key]
             raise KeyError('Key not found,', key)
                         
-    def load_keys(self, row_to_key: callable, filter_function: callable=lambda x:True) -> None:
+    def load_keys(self, row_to_key: callable, filter_function: callable=lambda x:True, prefetch: int = 0) -> None:
         """
         Compute keys of each row and set index to reflect computed keys
 
         :param row_to_key: Function used to compute keys
         :param filter_function: Function to filter. The function takes an FDDReadRow and returns a boolean (true if the row should be kept)
+        :param prefetch: The number of rows the OS is asked to read ahead at once, see RFDDImpl.load_keys.
         """
         for rfdd in self.rfdds:
-            rfdd.load_keys(row_to_key,filter_function)
+            rfdd.load_keys(row_to_key,filter_function,prefetch)
 
         self.all_keyless = False
 
         
         
-    def filter(self, filter_function: callable, row_to_key: callable=None) -> None:
+    def filter(self, filter_function: callable, row_to_key: callable=None, prefetch: int = 0) -> None:
         """
         Filter rows of FDD. Optionally also load keys using the given function.
 
         :param filter_function: Function to filter. The function takes an FDDReadRow and returns a boolean (true if the row should be kept)
         :param row_to_key: Function used to compute keys
+        :param prefetch: The number of rows the OS is asked to read ahead at once, see RFDDImpl.load_keys.
+        """
+        self.load_keys(row_to_key, filter_function, prefetch)
+
+    def compact_index(self) -> None:
+        """
+        Compacts the index of every FDD. See RFDDImpl.compact_index.
         """
-        self.load_keys(row_to_key, filter_function)
+        for rfdd in self.rfdds:
+            rfdd.compact_index()
 
         
 
@@ -589,16 +1471,23 @@ class RFDDCombined:
 def RFDD(filename: str,
          split: str = 'all_rows',
          allow_cell_modification: bool = False,
-         system_deserialize: callable = pkl.loads) -> RFDDImpl | RFDDCombined:
+         system_deserialize: callable = pkl.loads,
+         cache_path: Optional[str] = None,
+         lazy_splits: bool = False,
+         read_row_reuse: bool = False,
+         random_access: bool = False,
+         read_row_cache_size: int = 1) -> RFDDImpl | RFDDCombined:
     """
     Factory function to open FDD for reading
     
     :return: RFDD described by filename as appropriate datatype (RFDDImpl | RFDDCombined)
     """
     if ',' in filename:
-        return RFDDCombined(filename, split, allow_cell_modification, system_deserialize)
+        return RFDDCombined(filename, split, allow_cell_modification, system_deserialize, cache_path, lazy_splits, read_row_reuse,
+                            random_access, read_row_cache_size)
     else:
-        return RFDDImpl(filename, split, allow_cell_modification, system_deserialize)
+        return RFDDImpl(filename, split, allow_cell_modification, system_deserialize, cache_path, lazy_splits, read_row_reuse,
+                        random_access, read_row_cache_size)
     
     
 
@@ -617,15 +1506,26 @@ class FDDReadRow:
     """
 
     def __init__(self, index: Tuple[Any], parent, ) -> None:
-        self._fdd_row_index = index
-        self._fdd_row_parent = parent
-        self._fdd_row_cache = [None for _ in range(len(self._fdd_row_index) - 1)]
+        # set through __dict__ to skip __setattr__, as a row is created for every lookup
+        row_dict = self.__dict__
+        row_dict['_fdd_row_index'] = index
+        row_dict['_fdd_row_parent'] = parent
+        # column position -> value, for the columns that are loaded (or were set). Loaded None values are cached too.
+        row_dict['_fdd_row_cache'] = {}
+
+    def _fdd_row_reset(self, index: Tuple[Any]) -> None:
+        # points the row at another row of the same parent, forgetting everything loaded so far
+        self.__dict__['_fdd_row_index'] = index
+        self._fdd_row_cache.clear()
 
     def as_dict(self):
         """
         :return: A dictionary representation of the row.
         """
-        return {k: self[i] for i, k in enumerate(self._fdd_row_parent.columns)}
+        self.materialize()
+        # materialize leaves every column in the cache
+        cache = self._fdd_row_cache
+        return {k: cache[i] for i, k in enumerate(self._fdd_row_parent.columns)}
     
     def dict(self):
         return self.as_dict()
@@ -638,19 +1538,83 @@ class FDDReadRow:
         :return: The value of the column.
         """
         if isinstance(key, str):
-            key = self._fdd_row_parent.columns[key]
-        if self._fdd_row_cache[key] is None:
-            start = self._fdd_row_index[key]
-            end = self._fdd_row_index[key+1]
+            key = _column_positions(self._fdd_row_parent.columns)[key]
+        if key not in self._fdd_row_cache:
+            row_index = self._fdd_row_index
+            if type(row_index) is FDDIntList:
+                start, end = row_index.span(key)
+            else:
+                start, end = row_index[key], row_index[key+1]
             if start == end:
                 self._fdd_row_cache[key] = None
                 # alternatively, we could raise an error here
+            elif self._fdd_row_parent.disk_cache is not None or end - start >= _ZERO_COPY_MIN_BYTES:
+                deserialize = self._fdd_row_parent.column_to_deserialize[key]
+                self._fdd_row_cache[key] = self._fdd_row_parent.deserialize_chunk(start, end, deserialize)
             else:
                 deserialize = self._fdd_row_parent.column_to_deserialize[key]
-                self._fdd_row_cache[key] = deserialize(self._fdd_row_parent.read_chunk(start, end))
-            
+                data = self._fdd_row_parent.read_chunk(start, end)
+                self._fdd_row_cache[key] = data if deserialize is _identity else deserialize(data)
 
         return self._fdd_row_cache[key]
+
+    def prefetch_all(self) -> None:
+        """
+        Loads every column that is not cached yet using a single read that spans the whole row.
+        """
+        self.materialize(parallel=False)
+
+    def materialize(self, parallel: bool = True) -> None:
+        """
+        Loads every column that is not cached yet using a single read that spans the whole row.
+        With parallel=True, large rows are deserialized one column per thread, which is faster
+        when the deserializers release the GIL (e.g. numpy, zstandard, Pillow).
+
+        :param parallel: Whether to deserialize columns in parallel.
+        """
+        self._fdd_row_materialize(parallel)
+
+    def _fdd_row_materialize(self, parallel: bool, data: Optional[bytes] = None, data_start: int = 0) -> None:
+        # data, if given, is a slice of the file starting at data_start that covers the whole row
+        # decoded once up front (in bulk for packed rows), so the loop below does plain tuple indexing
+        index = tuple(self._fdd_row_index)
+        num_columns = len(index) - 1
+        row_start, row_end = index[0], index[num_columns]
+        cache = self._fdd_row_cache
+        column_to_deserialize = self._fdd_row_parent.column_to_deserialize
+        view = None
+        pending = []
+        for i in range(num_columns):
+            if i in cache:
+                continue
+            start, end = index[i], index[i+1]
+            if start == end:
+                cache[i] = None
+                continue
+            if not row_start <= start < end <= row_end or self._fdd_row_parent.disk_cache is not None:
+                # not stored contiguously with the rest of the row, or served by the disk cache
+                self[i]
+                continue
+            if data is None:
+                data = self._fdd_row_parent.read_chunk(row_start, row_end)
+                data_start = row_start
+            if end - start >= _ZERO_COPY_MIN_BYTES and column_to_deserialize[i] in _BUFFER_DESERIALIZERS:
+                # a view of the row's bytes, so large cells are not copied a second time before decoding
+                if view is None:
+                    view = memoryview(data)
+                pending.append((i, view[start-data_start:end-data_start]))
+            else:
+                pending.append((i, data[start-data_start:end-data_start]))
+        if not pending:
+            return
+
+        if parallel and len(pending) > 1 and row_end - row_start >= _PARALLEL_DESERIALIZE_MIN_BYTES:
+            pool = self._fdd_row_parent.get_deserialize_pool()
+            values = pool.map(lambda pending_column: column_to_deserialize[pending_column[0]](pending_column[1]), pending)
+        else:
+            values = [chunk if column_to_deserialize[i] is _identity else column_to_deserialize[i](chunk) for i, chunk in pending]
+        for (i, _), value in zip(pending, values):
+            cache[i] = value
     
     def __setitem__(self, key: int | str, value: Any) -> None:
         """
@@ -660,7 +1624,7 @@ class FDDReadRow:
         :param value: The value to set.
         """
         if isinstance(key, str):
-            key = self._fdd_row_parent.columns[key]
+            key = _column_positions(self._fdd_row_parent.columns)[key]
         self._fdd_row_cache[key] = value
 
     def __getattr__(self, name: str) -> Any:
@@ -674,13 +1638,10 @@ class FDDReadRow:
         if name.startswith('_fdd_row_'):
             return super().__getattr__(name)
         
-        columns: tuple | dict = self._fdd_row_parent.columns
-
-        if name not in columns:
+        index = _column_positions(self._fdd_row_parent.columns).get(name)
+        if index is None:
             raise AttributeError(f"Column not found: {name}")
         
-        index = columns[name] if isinstance(columns, dict) else columns.index(name)
-        
         return self[index]
     
     def __setattr__(self, name: str, value: Any) -> None:
@@ -696,11 +1657,10 @@ class FDDReadRow:
             return
         if isinstance(self._fdd_row_parent, WFDD) and not self._fdd_row_parent.allow_cell_modification:
             raise AttributeError("Row has already been finalized.")
-        columns = self._fdd_row_parent.columns
-        if name not in columns:
+        index = _column_positions(self._fdd_row_parent.columns).get(name)
+        if index is None:
             raise AttributeError(f"Column not found: {name}")
         
-        index = columns[name] if isinstance(columns, dict) else columns.index(name)
         self._fdd_row_cache[index] = value
         if self._fdd_row_parent.allow_cell_modification:
             self.write_to_disk(index,value)
@@ -713,10 +1673,9 @@ class FDDReadRow:
         value_bytes = serialize_fun(value)
         
         if len(value_bytes) == existing_end-existing_start:
-            save_pos = self._fdd_row_parent.file.tell()
-            self._fdd_row_parent.file.seek(existing_start)
-            self._fdd_row_parent.file.write(value_bytes)
-            self._fdd_row_parent.file.seek(save_pos)
+            _write_at(self._fdd_row_parent.file, existing_start, value_bytes)
+            if self._fdd_row_parent.disk_cache is not None:
+                self._fdd_row_parent.disk_cache.forget(existing_start)
         else:
             raise ValueError("The new cell data must be the same size as the data in the cell it's replacing. Existing size,", existing_end-existing_start, "New size,", len(value_bytes))
 
@@ -753,22 +1712,23 @@ class FDDReadRow:
         """
         Yields (column name, value) pairs for the row.
         """
-        for i, key in enumerate(self._fdd_row_parent.columns):
-            yield key, self[i]
+        self.materialize()
+        # materialize leaves every column in the cache
+        columns = self._fdd_row_parent.columns
+        yield from zip(columns, map(self._fdd_row_cache.__getitem__, range(len(columns))))
 
     def keys(self) -> Iterator[str]:
         """
         Yields the column names for the row.
         """
-        for key in self._fdd_row_parent.columns:
-            yield key
+        yield from self._fdd_row_parent.columns
     
     def values(self) -> Iterator[Any]:
         """
         Yields the values for the row.
         """
-        for i, key in enumerate(self._fdd_row_parent.columns):
-            yield self[i]
+        self.materialize()
+        yield from map(self._fdd_row_cache.__getitem__, range(len(self._fdd_row_parent.columns)))
 
     
     
@@ -776,12 +1736,93 @@ class FDDReadRow:
         """
         :return: A human readable string representation of the row. One line per column.
         """
+        self.materialize()
         rep = ""
         for i, key in enumerate(self._fdd_row_parent.columns):
             value = self[i]
             rep += f"{key}: {value}\n"
         return rep
 
+def _column_positions(columns: Union[Dict[str, int], Sequence[str]]) -> Dict[str, int]:
+    """
+    Returns a dict from column name to position. RFDD columns already are one; WFDD keeps the names in a tuple,
+    whose dict is built once and shared, so that looking a column up by name is a hash lookup rather than a scan.
+
+    :param columns: The columns of an FDD.
+    """
+    if type(columns) is dict:
+        return columns
+    return _tuple_column_positions(tuple(columns))
+
+# the schemas below are memoized for the life of the process, so the caches are bounded for processes
+# that open many differently shaped files, or build their serializers anew for each file
+@lru_cache(maxsize=128)
+def _tuple_column_positions(columns: Tuple[str]) -> Dict[str, int]:
+    return {name: i for i, name in enumerate(columns)}
+
+def _row_class_for(columns: Iterable[str]) -> type:
+    """
+    Returns a subclass of FDDReadRow with a property for each column, so that row.column
+    is resolved by normal attribute lookup instead of falling through to __getattr__.
+    Classes are shared between FDDs with the same columns.
+
+    :param columns: The column names, in order.
+    """
+    return _tuple_row_class(tuple(columns))
+
+@lru_cache(maxsize=128)
+def _tuple_row_class(columns: Tuple[str]) -> type:
+    namespace = {}
+    for i, name in enumerate(columns):
+        # columns named like FDDReadRow methods stay reachable through row[name] only, as before
+        if isinstance(name, str) and not hasattr(FDDReadRow, name):
+            namespace[name] = property(lambda self, i=i: self[i])
+    return type('FDDReadRow', (FDDReadRow,), namespace)
+
+@lru_cache(maxsize=128)
+def _row_writers_for(columns: Tuple[str], serializers: Tuple[callable]) -> Tuple[callable, callable]:
+    """
+    Generates WFDD row writers specialized for a schema, with the loop over columns unrolled.
+    Returns a writer for tuples, and one for dicts that returns False for dicts
+    that don't have exactly the columns as keys, so that WFDD.__setitem__ can validate those as usual.
+    Writers are shared between WFDDs with the same columns and serializers.
+
+    :param columns: The column names, in order.
+    :param serializers: The serializer of each column.
+    """
+    n = len(columns)
+    values = '(' + ''.join(f'v{i}, ' for i in range(n)) + ')'
+    # the body of WFDD._write_row, unrolled: serialize each cell, and add up the positions as it goes.
+    # Cells without a value are written as b'', so the cells go to writelines as they are
+    write_row = (
+        ''.join(f'    d{i} = serialize{i}(v{i}) if v{i} is not None else b""\n' for i in range(n)) +
+        f'    p0 = wfdd._write_pos\n' +
+        ''.join(f'    p{i+1} = p{i} + (len(d{i}) if type(d{i}) is bytes else memoryview(d{i}).nbytes)\n' for i in range(n)) +
+        f'    wfdd.file.writelines((' + ''.join(f'd{i}, ' for i in range(n)) + '))\n'
+        f'    wfdd.__dict__["_write_pos"] = p{n}\n'
+        f'    wfdd.index[key] = (' + ''.join(f'p{i}, ' for i in range(n + 1)) + ')\n'
+    )
+    source = (
+        f'def write_tuple(wfdd, key, item):\n'
+        f'    if len(item) != {n}:\n'
+        f'        raise ValueError("Incorrect number of columns.")\n'
+        f'    {values} = item\n'
+        + write_row +
+        f'def write_dict(wfdd, key, item):\n'
+        f'    if len(item) != {n}:\n'
+        f'        return False\n'
+        f'    try:\n'
+        + ''.join(f'        v{i} = item[column{i}]\n' for i in range(n)) + '        pass\n' +
+        f'    except KeyError:\n'
+        f'        return False\n'
+        + write_row +
+        f'    return True\n'
+    )
+    namespace = {f'column{i}': c for i, c in enumerate(columns)}
+    namespace.update({f'serialize{i}': f for i, f in enumerate(serializers)})
+    exec(source, namespace)
+    return namespace['write_tuple'], namespace['write_dict']
+
 class WFDD(BaseFDD):
     """
     WFDD (Freeze Dried Data Writer) class for writing freeze-dried data files.
@@ -791,6 +1832,9 @@ class WFDD(BaseFDD):
     :param overwrite: Whether to overwrite an existing file, default is False.
     :param reopen: Whether to reopen an existing file, default is False.
     :param system_serialize: The function to use for serializing the index, splits, and columns.
+    :param index_compression: None, 'zlib' or 'zstd' (requires the zstandard package).
+        Compresses the index and splits, which shrinks files with many rows and speeds up opening them from slow storage.
+        When reopening, None keeps the compression the file was written with.
     
 
     """
@@ -800,11 +1844,16 @@ class WFDD(BaseFDD):
                  overwrite: bool = False,
                  reopen: bool = False,
                  allow_cell_modification = False,
-                 system_serialize: callable = pkl.dumps,
+                 system_serialize: callable = _pkl_dumps,
                  system_deserialize: callable = pkl.loads,
+                 index_compression: Optional[str] = None,
                  ) -> None:
         self.__dict__['_initializing'] = True # Use self.__dict__ to bypass __setattr__
         super().__init__(filename)
+
+        if index_compression not in (None, 'zlib', 'zstd'):
+            raise ValueError("index_compression must be None, 'zlib' or 'zstd'.", index_compression)
+        self.index_compression = index_compression
         
         
         if not overwrite and not reopen and os.path.exists(filename):
@@ -813,15 +1862,10 @@ class WFDD(BaseFDD):
         if reopen and not os.path.exists(filename):
             raise FileNotFoundError("File not found.", filename)
         
-        column_to_serialize = {v: type_to_serializer[t] if isinstance(t, str) else t[0] for v, t in columns.items()} if columns is not None else None
-        
-        column_to_deserialize = {v: type_to_deserializer[t] if isinstance(t, str) else t[1] for v, t in columns.items()} if columns is not None else None
-        
         self.allow_cell_modification = allow_cell_modification
 
         if columns is not None:
-            self.column_to_deserialize = tuple(column_to_deserialize.values())
-            self.column_to_serialize = tuple(column_to_serialize.values())
+            self.column_to_serialize, self.column_to_deserialize = _column_codecs(columns)
         else:
             self.column_to_deserialize = None
             self.column_to_serialize = None
@@ -829,14 +1873,15 @@ class WFDD(BaseFDD):
         
         self.system_serialize = system_serialize
         self.system_deserialize = system_deserialize
-        self.no_columns_serialize = pkl.dumps
+        self.no_columns_serialize = _pkl_dumps
         self.no_columns_deserialize = pkl.loads
 
         if reopen:
             self.reopen()
             
         else:
-            self.file = open(filename, 'wb+')
+            self.file = open(filename, 'wb+', buffering=_WRITE_BUFFER_BYTES)
+            self._write_pos = 0
             self.unfinished_setters = {}
             
             self.columns = tuple(columns.keys()) if columns is not None else None
@@ -856,6 +1901,9 @@ class WFDD(BaseFDD):
             self.column_def=columns
 
 
+        # without columns, each row is a single cell written through the same generated code
+        self._row_writers = (_row_writers_for(self.columns, self.column_to_serialize) if self.columns is not None
+                             else _row_writers_for((None,), (self.no_columns_serialize,)))
         self._initializing = False
 
     def __setattr__(self, name: str, value: Any) -> None:
@@ -890,10 +1938,14 @@ class WFDD(BaseFDD):
         :param end: The end position of the chunk.
         :return: The data read from the file.
         """
-        pos = self.file.tell()
+        if hasattr(os, 'pread'):
+            # one positioned read that leaves the write position alone, instead of seeking there and back.
+            # Buffered writes must reach the file first, which a seek used to do implicitly.
+            self.file.flush()
+            return os.pread(self.file.fileno(), end - start, start)
         self.file.seek(start)
         data = self.file.read(end - start)
-        self.file.seek(pos)
+        self.file.seek(self._write_pos)
         return data
 
     def __getitem__(self, key: Any) -> Union[Any, 'FDDSetter']:
@@ -903,24 +1955,20 @@ class WFDD(BaseFDD):
         :param key: The key of the item.
         :return: The item corresponding to the key.
         """
-        if key not in self.index:
+        index = self.index
+        if key not in index:
             if self.columns is None:
                 raise KeyError("Key not found.", key)
             if key not in self.unfinished_setters:
                 self.unfinished_setters[key] = FDDSetter(self, key)
             return self.unfinished_setters[key]
-        else:
-            if self.columns is None:
-                start,end = self.index[key]
-                data = self.read_chunk(start, end)
-                return self.no_columns_deserialize(data)
+        elif self.columns is None:
+            row_index = index[key]
+            start, end = row_index.span(0) if type(row_index) is FDDIntList else row_index
+            return self.no_columns_deserialize(self.read_chunk(start, end))
         
-        pos = self.file.tell()
-        #TODO: investigate, I think read-row needs to know where to seek after it does the reading.
-        #the tests do check to make sure this works though.
-        row = FDDReadRow(self.index[key], self) 
-        self.file.seek(pos)
-        return row
+        # reads made by the row go through read_chunk, which restores the write position
+        return FDDReadRow(index[key], self)
         
     def __setitem__(self, key: Any, item: dict[str, Any] | tuple[Any] | FDDReadRow | Any) -> None:
         """
@@ -933,26 +1981,34 @@ class WFDD(BaseFDD):
             raise KeyError("Key already exists.", key)
         
         if self.columns is None:
-            item = (item,)
+            self._row_writers[0](self, key, (item,))
+            return
+        elif type(item) is tuple:
+            self._row_writers[0](self, key, item)
+            return
+        elif type(item) is dict and self._row_writers[1](self, key, item):
+            return
         elif isinstance(item, FDDReadRow):
-            positions = [self.file.tell()]
+            if not item._fdd_row_cache and self._copy_row_in_kernel(key, item):
+                return
+            cells = []
             for i in range(len(self.columns)):
                 # if it's in cache, serialize it and write it, otherwise, write the raw bytes
-                if item._fdd_row_cache[i] is not None:
-                    serialize = self.column_to_serialize[i]
-                    data = serialize(item._fdd_row_cache[i])
+                if i in item._fdd_row_cache:
+                    value = item._fdd_row_cache[i]
+                    cells.append(self.column_to_serialize[i](value) if value is not None else None)
                 else:
-                    data = item._fdd_row_parent.read_chunk(item._fdd_row_index[i], item._fdd_row_index[i+1])
-                self.file.write(data)
-                positions.append(self.file.tell())
-            self.index[key] = tuple(positions)
+                    cells.append(item._fdd_row_parent.read_chunk(item._fdd_row_index[i], item._fdd_row_index[i+1]))
+            self._write_row(key, cells)
             return
         elif isinstance(item, dict):
-            if all(col not in item for col in self.columns):
+            # the keys of the memoized name -> position dict of the columns serve as the set of column names
+            column_names = _column_positions(self.columns).keys()
+            if column_names.isdisjoint(item):
                 raise ValueError("Dict contains no entries for columns.", [col for col in self.columns if col not in item])
-            if any(col not in self.columns for col in item):
-                raise ValueError("Dict contains columns not in the column list.", [col for col in item if col not in self.columns])
-            item = tuple(item.get(col) for col in self.columns)
+            if not column_names >= item.keys():
+                raise ValueError("Dict contains columns not in the column list.", [col for col in item if col not in column_names])
+            item = tuple(map(item.get, self.columns))
         elif isinstance(item, tuple):
             if len(item) != len(self.columns):
                 raise ValueError("Incorrect number of columns.")
@@ -962,18 +2018,86 @@ class WFDD(BaseFDD):
         else:
             raise ValueError("Invalid type for column mode. Must be dict, tuple, or object with attributes matching the columns.")
         
-        positions = [self.file.tell()]
-        for i, v in enumerate(item):
-            if v is not None:
-                if self.columns is not None:
-                    serialize = self.column_to_serialize[i]
-                else:
-                    serialize = self.no_columns_serialize
-                data = serialize(v)
-                self.file.write(data)
-            positions.append(self.file.tell())
-            
-        self.index[key] = tuple(positions)
+        serializers = self.column_to_serialize if self.columns is not None else (self.no_columns_serialize,)
+        self._write_row(key, [serialize(v) if v is not None else None for serialize, v in zip(serializers, item)])
+
+    def _write_row(self, key: Any, cells: List[Optional[bytes]]) -> None:
+        """
+        Writes the serialized cells of a row with a single call and adds the row to the index.
+
+        :param key: The key of the row.
+        :param cells: The serialized data for each column, None for columns without a value.
+        """
+        offset = self._write_pos
+        positions = [offset]
+        for data in cells:
+            if data is not None:
+                offset += len(data) if type(data) is bytes else memoryview(data).nbytes
+            positions.append(offset)
+        self.file.writelines([data for data in cells if data is not None])
+        self.__dict__['_write_pos'] = offset # bypass __setattr__ in the hot path
+        self.index[key] = positions
+
+    def _copy_row_in_kernel(self, key: Any, row: 'FDDReadRow') -> bool:
+        """
+        Copies the bytes of an unmodified row from the file of an RFDD with copy_file_range,
+        so that large rows go from page cache to page cache without passing through Python.
+
+        :param key: The key of the row.
+        :param row: The row to copy.
+        :return: False if the row was not copied, because it is small, not stored contiguously,
+            or the platform or file system does not support it.
+        """
+        source = row._fdd_row_parent
+        index = tuple(row._fdd_row_index)
+        start, end = index[0], index[-1]
+        if (end - start < _KERNEL_COPY_MIN_BYTES or not isinstance(source, RFDDImpl)
+                or list(index) != sorted(index)):
+            return False
+        dst_start = self._write_pos
+        if not self._copy_in_kernel(source, start, end):
+            return False
+        self.index[key] = tuple(i - start + dst_start for i in index)
+        return True
+
+    def _copy_in_kernel(self, source: 'RFDDImpl', start: int, end: int) -> bool:
+        """
+        Appends bytes start:end of the file of an RFDD with copy_file_range.
+
+        :return: False if nothing was copied because the platform or file system does not support it.
+        """
+        if not hasattr(os, 'copy_file_range'):
+            return False
+        self.file.flush()
+        dst_start = self._write_pos
+        copied = 0
+        try:
+            while copied < end - start:
+                n = os.copy_file_range(source.file.fileno(), self.file.fileno(), end - start - copied,
+                                       start + copied, dst_start + copied)
+                if n == 0:
+                    raise OSError('copy_file_range stopped early')
+                copied += n
+        except OSError:
+            # e.g. copies between file systems on older kernels; the caller writes the row itself
+            self.file.seek(dst_start)
+            return False
+
+        self.file.seek(dst_start + copied)
+        self.__dict__['_write_pos'] = dst_start + copied
+        return True
+
+    def _write(self, data: bytes) -> Tuple[int, int]:
+        """
+        Appends data to the file.
+
+        :param data: The data to write.
+        :return: The start and end positions of the data in the file.
+        """
+        start = self._write_pos
+        self.file.write(data)
+        self.__dict__['_write_pos'] = start + (len(data) if type(data) is bytes else memoryview(data).nbytes)
+        return start, self._write_pos
 
     def add_split(self, *args, **kwargs) -> None:
         self.make_split(*args, **kwargs)
@@ -998,27 +2122,21 @@ class WFDD(BaseFDD):
             
             if keyless:
                 split_index = FDDIndexKeyless(num_vals=len(self.columns)+1 if self.columns is not None else 2)
-                i=0
-                for key in rows:
-                    if not filter_func or filter_func(self[key]):
-                        split_index[i] = self.index[key]
-                        i+=1
+                split_index.extend([self.index[key] for key in rows if not filter_func or filter_func(self[key])])
             else:
-                # split_index_dict = {key: self.index[key] for key in rows}
-                split_index_dict = {}
-                for key in rows:
-                    if not filter_func or filter_func(self[key]):
-                        split_index_dict[key] = self.index[key]
-                
-                try:
-                    if not preserve_order:
-                        split_index = FDDIndexComparableKey(split_index_dict)
-                    else:
-                        raise ValueError("dummy error go to except block")
-                except:
+                # only the keys are collected; the offsets are copied straight from the main index into the split
+                keys = list(dict.fromkeys(key for key in rows if not filter_func or filter_func(self[key])))
+
+                split_index = None
+                if not preserve_order:
+                    try:
+                        split_index = FDDIndexComparableKey(self.index, keys=keys)
+                    except (TypeError, IndexError):
+                        # keys that cannot be sorted, or an empty split
+                        pass
+                if split_index is None:
                     split_index = FDDIndexGeneral(len(self.columns)+1 if self.columns is not None else 2)
-                    for k,v in split_index_dict.items():
-                        split_index[k] = v
+                    split_index.update({key: self.index[key] for key in keys})
             if split == 'all_rows':
                 self.index = split_index
             else:
@@ -1037,19 +2155,48 @@ class WFDD(BaseFDD):
             raise ValueError("Split not found.", split)
         
         if isinstance(rows, (list, tuple, set, frozenset)):
-            self.split_to_index[split].update({key: self.index[key] for key in rows})
+            split_index = self._get_split(split)
+            for key in rows:
+                split_index[key] = self.index[key]
         else:
             raise ValueError("Rows must be an iterable of keys.")
+
+    def _get_split(self, split: str) -> FDDIndexBase:
+        """
+        Returns the index of a split, loading it first if it is still stored as bytes from reopen.
+        """
+        split_index = self.split_to_index[split]
+        if type(split_index) is bytes:
+            if split_index[:1] == b'\01':
+                split_index = _widen_keyless(FDDOnDiskIndex(_HeaderReader(split_index, 0), 1).get_keyless_index())
+            else:
+                split_index = _load_index(split_index, self.system_deserialize)
+            self.split_to_index[split] = split_index
+        return split_index
         
     def reopen(self) -> None:
-        self.file = open(self.filename, 'rb+')
+        self.file = open(self.filename, 'rb+', buffering=_WRITE_BUFFER_BYTES)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        # set to the end of the rows once the index has been read
+        self._write_pos = 0
         self.file.seek(-8, 2)
-        index_index_size = int.from_bytes(self.file.read(8), 'little')
+        index_index_size, = _UINT64.unpack(self.file.read(8))
 
         self.file.seek(-(8 + index_index_size), 2)
-        earliest = self.file.tell()
+        index_index_start = self.file.tell()
         index_index_data = self.file.read(index_index_size)
-        index_index = self.system_deserialize(index_index_data)
+        index_index = _load_index(index_index_data, self.system_deserialize)
+        if self.index_compression is None:
+            # keep the compression the file was written with. The index_index is always written through the
+            # same serializer as the row indices, while all_rows may be keyless and then never compressed
+            self.index_compression = _INDEX_MAGIC_TO_COMPRESSION.get(index_index_data[:4])
+
+        # the splits, columns and properties are all written after the rows, so they are read with a single read
+        # starting at the earliest of them, which is also where the rows end
+        earliest = min([index_index_start] + [start for start, _ in index_index.values()])
+        self.file.seek(earliest)
+        headers = _HeaderReader(self.file.read(index_index_start - earliest), earliest)
         
         self.split_to_index = {k[7:]:v for k,v in index_index.items() if k.startswith('_split_')}
 
@@ -1058,39 +2205,26 @@ class WFDD(BaseFDD):
             index_index.pop('_split_'+k)
 
         index_start, index_end = self.split_to_index["all_rows"]
-        earliest = min(index_start,earliest)
         
-        self.file.seek(index_start)
-        keyless_indicator = self.file.read(1)
+        keyless_indicator = headers.read_chunk(index_start, index_start+1)
         if keyless_indicator ==b'\01':
-            self.index = FDDOnDiskIndex(self,index_start+1)
-            self.index = self.index.get_keyless_index()
+            self.index = FDDOnDiskIndex(headers,index_start+1)
+            self.index = _widen_keyless(self.index.get_keyless_index())
         else:
-            self.index = self.system_deserialize(self.read_chunk(index_start, index_end))
+            self.index = _load_index(headers.read_chunk(index_start, index_end), self.system_deserialize)
 
-        new_split_to_index = {}
-        for k,v in self.split_to_index.items():
-            if k == "all_rows":
-                continue
-            split_start, split_end = v
-            earliest = min(split_start,earliest)
-            self.file.seek(split_start)
-            keyless_indicator = self.file.read(1)
-            if keyless_indicator ==b'\01':
-                new_split_to_index[k] = FDDOnDiskIndex(self, split_start+1).get_keyless_index()
-            else:
-                new_split_to_index[k] = self.system_deserialize(self.read_chunk(split_start, split_end))
-
-        self.split_to_index = new_split_to_index
+        # the other splits are kept as the bytes they are stored as. They are only loaded if they are written to,
+        # and close() writes the untouched ones back as they are
+        self.split_to_index = {k: headers.read_chunk(split_start, split_end)
+                               for k, (split_start, split_end) in self.split_to_index.items() if k != "all_rows"}
         
         if '_columns_' not in index_index:
             self.columns = None
         else:
             columns_start, columns_end = index_index['_columns_']
-            earliest = min(columns_start, earliest)
             index_index.pop('_columns_')
 
-            self.columns = self.system_deserialize(self.read_chunk(columns_start, columns_end))
+            self.columns = self.system_deserialize(headers.read_chunk(columns_start, columns_end))
             
         self.custom_properties = {k[6:]:v for k,v in index_index.items() if k.startswith('_prop_')}
 
@@ -1100,16 +2234,12 @@ class WFDD(BaseFDD):
             column_def_start, column_def_end = index_index['_column_def_']
             index_index.pop('_column_def_')
             try:
-                self.column_def = self.system_deserialize(self.read_chunk(column_def_start, column_def_end))
+                self.column_def = self.system_deserialize(headers.read_chunk(column_def_start, column_def_end))
             except Exception as e:
                 import dill
-                self.column_def = dill.loads(self.read_chunk(column_def_start, column_def_end))
+                self.column_def = dill.loads(headers.read_chunk(column_def_start, column_def_end))
 
-            self.column_to_deserialize = {v: type_to_deserializer[t] if isinstance(t, str) else t[1] for v, t in self.column_def.items()}   
-            self.column_to_deserialize = tuple(self.column_to_deserialize.values())
-
-            self.column_to_serialize = {v: type_to_serializer[t] if isinstance(t, str) else t[0] for v, t in self.column_def.items()}   
-            self.column_to_serialize = tuple(self.column_to_serialize.values())
+            self.column_to_serialize, self.column_to_deserialize = _column_codecs(self.column_def)
             
 
             
@@ -1118,15 +2248,14 @@ class WFDD(BaseFDD):
         new_custom_properties = {}
         for k,v in self.custom_properties.items():
             prop_start, prop_end = v
-            if prop_start < earliest:
-                earliest = prop_start
-            new_custom_properties[k] = self.system_deserialize(self.read_chunk(prop_start, prop_end))
+            new_custom_properties[k] = self.system_deserialize(headers.read_chunk(prop_start, prop_end))
         self.custom_properties = new_custom_properties
         
 
         self.unfinished_setters = {}
 
         self.file.seek(earliest)
+        self._write_pos = earliest
 
     def close(self) -> None:
         """
@@ -1147,6 +2276,7 @@ class WFDD(BaseFDD):
             Writing {} unfinished setters to disk now.
             """.format(len(cpy)), UserWarning)
 
+        # dicts keep insertion order, so unfinished rows are written in the order they were started
         for k in cpy:
             self.unfinished_setters[k].finalize()
 
@@ -1160,7 +2290,6 @@ class WFDD(BaseFDD):
         
         if self.column_def is not None:
             
-            column_def_start = self.file.tell()
             if not has_lambda:
                 column_def_data = self.system_serialize(self.column_def)
             else:
@@ -1168,54 +2297,56 @@ class WFDD(BaseFDD):
                 import dill
                 column_def_data = dill.dumps(self.column_def)
 
-            self.file.write(column_def_data)
-            column_def_end = self.file.tell()
-            index_index['_column_def_'] = (column_def_start, column_def_end)
+            index_index['_column_def_'] = self._write(column_def_data)
 
 
 
         for k,v in self.custom_properties.items():
-            property_start = self.file.tell()
             property_data = self.system_serialize(v)
-            self.file.write(property_data)
-            property_end = self.file.tell()
-            index_index["_prop_"+k] = (property_start, property_end)
+            index_index["_prop_"+k] = self._write(property_data)
+
+        # the indices are large and contain no shared references, so skip the pickle memo for them
+        serialize_index = _pkl_dumps_unmemoized if self.system_serialize is _pkl_dumps else self.system_serialize
+        if self.index_compression is not None:
+            serialize_uncompressed = serialize_index
+            serialize_index = lambda index: _compress_index(serialize_uncompressed(index), self.index_compression)
 
         self.split_to_index['all_rows'] = self.index
         for k,v in self.split_to_index.items():
-            split_start = self.file.tell()
+            split_start = self._write_pos
             
-            if isinstance(v, FDDIndexKeyless):
+            if type(v) is bytes:
+                # a split from before a reopen that was not changed is still in its stored form
+                self._write(v)
+            elif isinstance(v, FDDIndexKeyless):
                 # split_data = v.get_index_bytes()
                 # split_data = b'\01'+split_data 
                 self.file.write(b'\01')
                 v.write_index_bytes(self.file)
+                self._write_pos = self.file.tell()
             elif isinstance(v, FDDOnDiskIndex):
                 self.file.write(b'\01')
                 v.get_keyless_index().write_index_bytes(self.file)
+                self._write_pos = self.file.tell()
             else:
-                split_data = self.system_serialize(v)
-                self.file.write(split_data)
-            split_end = self.file.tell()
-            index_index["_split_"+k] = (split_start, split_end)
+                split_data = serialize_index(v)
+                self._write(split_data)
+            index_index["_split_"+k] = (split_start, self._write_pos)
 
         if self.columns is not None:
-            columns_start = self.file.tell()
             columns_data = self.system_serialize(self.columns)
-            self.file.write(columns_data)
-            columns_end = self.file.tell()
-            index_index['_columns_'] = (columns_start, columns_end)
+            index_index['_columns_'] = self._write(columns_data)
 
         
-        index_index_data = self.system_serialize(index_index)
+        index_index_data = serialize_index(index_index)
         index_index_data_length = len(index_index_data)
 
-        self.file.write(index_index_data)
-        self.file.write(index_index_data_length.to_bytes(8, 'little'))
+        self._write(index_index_data)
+        self._write(_UINT64.pack(index_index_data_length))
         self.file.flush()
 
 
-        self.file.truncate(self.file.tell())
+        self.file.truncate(self._write_pos)
         super().close()
 
 class FDDSetter:
@@ -1229,10 +2360,14 @@ class FDDSetter:
     :param key: The key used to identify the data in the parent object.
     """
     def __init__(self, parent: 'WFDD', key: Any) -> None:
-        self._fdd_setter_parent = parent
-        self._fdd_setter_key = key
-        self._fdd_setter_data = {}
-        self._fdd_setter_finalized = False
+        # written to the instance dict directly, as __setattr__ is for columns
+        setter_dict = self.__dict__
+        setter_dict['_fdd_setter_parent'] = parent
+        setter_dict['_fdd_setter_key'] = key
+        setter_dict['_fdd_setter_data'] = {}
+        setter_dict['_fdd_setter_finalized'] = False
+        # column name -> position, shared by all rows of the parent; its length is the number of columns
+        setter_dict['_fdd_setter_positions'] = _column_positions(parent.columns)
 
     def finalize(self) -> None:
         """
@@ -1240,7 +2375,7 @@ class FDDSetter:
         """
         self._fdd_setter_parent[self._fdd_setter_key] = self._fdd_setter_data
         del self._fdd_setter_parent.unfinished_setters[self._fdd_setter_key]
-        self._fdd_setter_finalized = True
+        self.__dict__['_fdd_setter_finalized'] = True
     
     def __setattr__(self, name: str, value: Any) -> None:
         """
@@ -1253,35 +2388,30 @@ class FDDSetter:
             super().__setattr__(name, value)
             return
         
+        positions = self._fdd_setter_positions
+        if name not in positions:
+            raise AttributeError(f"Column not found: {name}")
+
         if self._fdd_setter_finalized:
             if not self._fdd_setter_parent.allow_cell_modification:
                 raise AttributeError("Row has already been finalized.")
             else:
+                # the row is on disk already, so the cell is overwritten in place
                 row_index = self._fdd_setter_parent.index[self._fdd_setter_key]
-                position = self._fdd_setter_parent.columns.index(name)
-                existing_start = row_index[position+1]
+                position = positions[name]
+                existing_start = row_index[position]
                 existing_end = row_index[position+1]
-                # print('writing')
-                # print(existing_start, existing_end)
                 serialize_fun = self._fdd_setter_parent.column_to_serialize[position]
                 value_bytes = serialize_fun(value)
                 if len(value_bytes) == existing_end-existing_start:
-                    save_pos=self._fdd_setter_parent.file.tell()
-                    self._fdd_setter_parent.file.seek(existing_start)
-                    self._fdd_setter_parent.file.write(value_bytes)
-                    self._fdd_setter_parent.file.seek(save_pos)
+                    _write_at(self._fdd_setter_parent.file, existing_start, value_bytes)
+                    return
                 else:
                     raise ValueError("The new cell data must be the same size as the data in the cell it's replacing. Existing size,", existing_end-existing_start, "New size,", len(value_bytes))
-
-                
-                
-        
-        columns = self._fdd_setter_parent.columns
-        if name not in columns:
-            raise AttributeError(f"Column not found: {name}")
         
-        self._fdd_setter_data[name] = value
-        if len(self._fdd_setter_data) == len(self._fdd_setter_parent.columns):
+        data = self._fdd_setter_data
+        data[name] = value
+        if len(data) == len(positions):
             self.finalize()
 
     def __setitem__(self, key: str, value: Any) -> None:
@@ -1321,23 +2451,19 @@ def add_column(input_path, output_path, column_name, column_data, overwrite=Fals
         with WFDD(output_path, columns=column_def, overwrite=overwrite) as wfdd:
             
             for key, value in column_data:
-                row_index = rfdd.index[key]
+                row_index = tuple(rfdd.index[key])
                 start, end = row_index[0], row_index[-1]
-
-                row_data = rfdd.read_chunk(start, end)
-
                 new_data_for_row = column_serialize(value)
-                current_index = list(row_index)
-                current_index.append(end+len(new_data_for_row))
-
-                start = wfdd.file.tell()
-
-                current_index = [i-current_index[0]+start for i in current_index]
 
-                wfdd.index[key] = tuple(current_index)
+                dst_start = wfdd._write_pos
+                wfdd.index[key] = [i - start + dst_start for i in row_index] + [end - start + dst_start + len(new_data_for_row)]
 
-                row_data+=new_data_for_row
-                wfdd.file.write(row_data)
+                # large rows go from page cache to page cache, and small ones are written straight from the map
+                if end - start < _KERNEL_COPY_MIN_BYTES or not wfdd._copy_in_kernel(rfdd, start, end):
+                    with memoryview(rfdd._mm)[start:end] as row_data:
+                        wfdd.file.write(row_data)
+                    wfdd.__dict__['_write_pos'] = dst_start + end - start
+                wfdd._write(new_data_for_row)
 
             # copy the splits
             rfdd.get_available_splits()
@@ -1,12 +1,58 @@
 import pickle as pkl
 import errno
+import mmap
 import os
-from typing import Any, Dict, Iterator, Tuple
+import queue
+import sys
+from collections import OrderedDict
+import threading
+from array import array
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import zlib
 import bz2
 import gzip
+from functools import partial
 # files are stored as: record,record,record,...,last record,index,index_length
 
+# indices written by close() in the packed layout start with this, where a pickled dict would start with b'\x80'
+PACKED_INDEX_MAGIC = b'FDDP'
+
+# records stored in more bytes than this are not kept in the value cache, so a few big records can't fill it
+CACHE_MAX_RECORD_BYTES = 1 << 20
+
+# records are collected in a buffer this large before being written, so small records don't cost a write call each
+WRITE_BUFFER_SIZE = 4 << 20
+
+class PackedIndex(Mapping):
+    """
+    A read-only index that maps each key to its record's position, plus one array of record offsets, instead of a dict
+    of (offset, length) tuples. Records are written back to back, so record i spans offsets[i]:offsets[i+1].
+    This is much smaller in memory than a dict of tuples, and loads without unpickling a tuple per record.
+    """
+
+    def __init__(self, keys: List[Any], offsets: array) -> None:
+        self.positions = dict(zip(keys, range(len(keys))))
+        self.offsets = offsets
+
+    def __getitem__(self, key: Any) -> Tuple[int, int]:
+        i = self.positions[key]
+        start = self.offsets[i]
+        return start, self.offsets[i+1] - start
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self.positions
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.positions)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def keys(self):
+        return self.positions.keys()
+
+
 class FDD:
     """
     A very simple format for machine learning datasets.
@@ -18,13 +64,23 @@ class FDD:
 
     CUSTOM_ATTRIBUTE_TAG = 'FDD_CUSTOM_ATTRIBUTES'
 
-    def __init__(self, filename: str, write_or_overwrite: bool = False, read_only: bool = False, compression: str = 'none') -> None:
+    def __init__(self, filename: str, write_or_overwrite: bool = False, read_only: bool = False, compression: str = 'none', serializer: str = 'pickle', preload: bool = False, async_write: bool = False,
+                 cache_size: int = 0) -> None:
         """
         Initialize a new or existing data file.
 
         :param filename: The file path used for storing data.
         :param write_or_overwrite: If True, any existing file will be overwritten.
         :param read_only: If True, opens the file in read-only mode and raises FileNotFoundError if the file does not exist.
+        :param compression: 'none', 'zlib', 'bz2', 'gzip', 'zstd' (needs the zstandard package), or a (compress, decompress) tuple.
+        :param serializer: How values are serialized: 'pickle', 'pickle5', 'msgpack', or a (dumps, loads) tuple.
+            Like compression, it must be the same when reading as when writing. The index keys are always pickled.
+        :param preload: If True, read the whole file into memory when opening it in read mode, so reads need no I/O at all.
+        :param async_write: If True, records are written to disk by a background thread in create mode,
+            so that producing the next record overlaps with writing the last ones.
+        :param cache_size: How many decoded values to keep in a least recently used cache, so that values read again
+            (e.g. in the next epoch) skip decompression and deserialization. 0 disables the cache.
+            Cached values are shared between reads, so they should not be modified.
         """
         self.__dict__['_initializing'] = True # Use self.__dict__ to bypass __setattr__
 
@@ -33,11 +89,17 @@ class FDD:
         self.write_or_overwrite = write_or_overwrite
         self.read_only = read_only
         self.compression = compression
+        self.preload = preload
+        self.async_write = async_write
+        self.cache_size = cache_size
+        # decoded values keyed by the record's offset, most recently used last
+        self._cache = OrderedDict() if cache_size > 0 else None
         self.custom_properties = {}
         
         
         # Compression functions dictionary
         self.initialize_compression(compression)
+        self.initialize_serializer(serializer)
 
         # Detects when something like PyTorch DataLoader clones the object.
         os.register_at_fork(after_in_child=self._after_fork)
@@ -57,12 +119,104 @@ class FDD:
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), self.filename)
         
         self.mode = 'create_mode' if not os.path.exists(self.filename) else 'read_mode'
-        self.file = open(self.filename, 'wb+' if self.mode == 'create_mode' else 'rb+')
+        if self.mode == 'create_mode':
+            self.file = open(self.filename, 'wb+', buffering=WRITE_BUFFER_SIZE)
+        else:
+            self.file = open(self.filename, 'rb+')
+        self._map_file()
         
         self.is_open = True
         self.index = self.get_existing_index() if self.mode == 'read_mode' else {}
+        # packed indices are looked up inline in __getitem__, which is cheaper than calling PackedIndex.__getitem__
+        self._positions = self._offsets = None
+        if isinstance(self.index, PackedIndex):
+            self._positions, self._offsets = self.index.positions, self.index.offsets
         if self.mode == 'create_mode':
             self.current_offset = 0
+        self._writeq = None
+        if self.mode == 'create_mode' and self.async_write:
+            self._write_error = None
+            self._writeq = queue.Queue(maxsize=64)
+            self._writer_thread = threading.Thread(target=self._writer, daemon=True)
+            self._writer_thread.start()
+
+    def _writer(self) -> None:
+        """
+        Background thread for async_write. Records arrive in offset order, so whatever is queued is joined
+        into one contiguous chunk and written with a single pwrite. A None record means the file is closing.
+        The first error is kept for the main thread to raise, and the queue keeps draining so that no put or join hangs.
+        """
+        fd = self.file.fileno()
+        closing = False
+        while not closing:
+            records = [self._writeq.get()]
+            try:
+                size = 0
+                while records[-1] is not None and size < WRITE_BUFFER_SIZE:
+                    size += len(records[-1][1])
+                    try:
+                        records.append(self._writeq.get_nowait())
+                    except queue.Empty:
+                        break
+                if records[-1] is None:
+                    closing = True
+                    records.pop()
+                if records and self._write_error is None:
+                    start = records[0][0]
+                    view = memoryview(b''.join([data for _, data in records]))
+                    while view:
+                        written = os.pwrite(fd, view, start)
+                        view, start = view[written:], start + written
+            except BaseException as e:
+                if self._write_error is None:
+                    self.__dict__['_write_error'] = e
+            finally:
+                for _ in range(len(records) + closing):
+                    self._writeq.task_done()
+
+    def _put_write(self, record: Optional[tuple]) -> None:
+        """
+        Queue a record for the writer thread, without blocking forever on a full queue if the thread has stopped.
+        """
+        while True:
+            try:
+                self._writeq.put(record, timeout=0.1)
+                return
+            except queue.Full:
+                if not self._writer_thread.is_alive():
+                    raise self._write_error or RuntimeError("The FDD async_write thread stopped.")
+
+    def _wait_for_writes(self) -> None:
+        """
+        With async_write, block until every queued record is on disk, and raise any error the writer thread hit.
+        """
+        if self._writeq is None:
+            return
+        # like self._writeq.join(), but it does not wait forever if the writer thread has stopped
+        with self._writeq.all_tasks_done:
+            while self._writeq.unfinished_tasks:
+                if not self._writer_thread.is_alive():
+                    raise self._write_error or RuntimeError("The FDD async_write thread stopped.")
+                self._writeq.all_tasks_done.wait(0.1)
+        if self._write_error is not None:
+            raise self._write_error
+
+    def _map_file(self) -> None:
+        """
+        In read mode, map the file into memory so that reads are served from the page cache without a seek and read call.
+        """
+        self._mm = None
+        if self.mode == 'read_mode' and os.fstat(self.file.fileno()).st_size > 0:
+            if self.preload:
+                # bytes slice and unpickle just like the map, but never page fault
+                self.file.seek(0)
+                self._mm = self.file.read()
+            else:
+                self._mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        # looked up once here rather than on every read
+        self._seek = self.file.seek
+        self._read = self.file.read
+        self._zero_copy = self._mm is not None and self.compression == 'none' and self._loads is pkl.loads
 
     def initialize_compression(self, compression):
         # Then use these in your compressors dictionary
@@ -72,6 +226,10 @@ class FDD:
             'gzip': (gzip.compress, gzip.decompress),
             'none': (lambda x: x, lambda x: x)
         }
+        if compression == 'zstd':
+            import zstandard
+            # one compression context is reused for every record instead of being set up per call
+            compressors['zstd'] = (zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress)
         if isinstance(compression, tuple) and len(compression) == 2 and callable(compression[0]) and callable(compression[1]):
             compressors['custom'] = compression
             compression = 'custom'
@@ -79,6 +237,25 @@ class FDD:
             raise ValueError(f"Unsupported compression type: {compression}")
         self.compressor = compressors[compression][0]
         self.decompressor = compressors[compression][1]
+        # without compression the per record paths skip calling the identity functions altogether
+        self._compress_skip = compression == 'none'
+
+    def initialize_serializer(self, serializer):
+        serializers = {
+            'pickle': (pkl.dumps, pkl.loads),
+            # protocol 5 writes large buffers (e.g. numpy arrays) without extra copies
+            'pickle5': (partial(pkl.dumps, protocol=5), pkl.loads),
+        }
+        if serializer == 'msgpack':
+            import msgpack
+            serializers['msgpack'] = (msgpack.packb, msgpack.unpackb)
+        if isinstance(serializer, tuple) and len(serializer) == 2 and callable(serializer[0]) and callable(serializer[1]):
+            serializers['custom'] = serializer
+            serializer = 'custom'
+        if serializer not in serializers:
+            raise ValueError(f"Unsupported serializer: {serializer}")
+        self._dumps = serializers[serializer][0]
+        self._loads = serializers[serializer][1]
 
     def __getattr__(self, name: str) -> Any:
         """
@@ -151,11 +328,19 @@ class FDD:
 
         :return: The index dictionary.
         """
-        self.file.seek(-8, 2)  # Move to the last 8 bytes for index size
-        index_size = int.from_bytes(self.file.read(8), 'little')
-        self.file.seek(-(8 + index_size), 2)
-        index_data = self.file.read(index_size)
-        index = pkl.loads(self.decompressor(index_data))
+        file_size = len(self._mm)
+        index_size = int.from_bytes(self._mm[file_size-8:], 'little') # the last 8 bytes hold the index size
+        index_data = self._mm[file_size-8-index_size:file_size-8]
+        index_data = self.decompressor(index_data)
+        if index_data[:4] == PACKED_INDEX_MAGIC:
+            header_size = int.from_bytes(index_data[4:12], 'little')
+            keys, self.custom_properties = pkl.loads(index_data[12:12+header_size])
+            offsets = array('Q')
+            offsets.frombytes(index_data[12+header_size:])
+            if sys.byteorder != 'little':
+                offsets.byteswap()
+            return PackedIndex(keys, offsets)
+        index = pkl.loads(index_data)
         if self.CUSTOM_ATTRIBUTE_TAG in index:
             self.custom_properties = index[self.CUSTOM_ATTRIBUTE_TAG]
             del index[self.CUSTOM_ATTRIBUTE_TAG]
@@ -166,17 +351,52 @@ class FDD:
         Close the file and save the index if in create mode.
         """
         if self.mode == 'create_mode':
-            if len(self.custom_properties) > 0:
-                self.index[self.CUSTOM_ATTRIBUTE_TAG] = self.custom_properties
-            index_data = self.compressor(pkl.dumps(self.index))
+            if self._writeq is not None:
+                try:
+                    self._put_write(None)
+                except BaseException as e:
+                    if self._write_error is None:
+                        self.__dict__['_write_error'] = e
+                self._writer_thread.join()
+                self._writeq = None
+                if self._write_error is not None:
+                    self.file.close()
+                    self.is_open = False
+                    raise self._write_error
+                # the records were written with pwrite, so the file position is still at the start
+                self.file.seek(self.current_offset)
+            index_data = self._packed_index_bytes()
+            if index_data is None:
+                if len(self.custom_properties) > 0:
+                    self.index[self.CUSTOM_ATTRIBUTE_TAG] = self.custom_properties
+                index_data = pkl.dumps(self.index)
+            index_data = self.compressor(index_data)
             index_data_length = len(index_data)
             self.file.write(index_data)
             self.file.write(index_data_length.to_bytes(8, 'little'))
         
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
         self.file.close()
         self.is_open = False
 
 
+    def _packed_index_bytes(self) -> bytes:
+        """
+        Serializes the index in the packed layout: the magic, the size of the pickled (keys, custom properties) header,
+        the header, and then the offset of every record plus the end of the last one as 8 byte ints.
+        Returns None if the records are not back to back in key order, in which case the index is pickled as a dict.
+        """
+        offsets = array('Q', [0])
+        for start, data_len in self.index.values():
+            if start != offsets[-1]:
+                return None
+            offsets.append(start + data_len)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        header = pkl.dumps((list(self.index), self.custom_properties))
+        return b''.join([PACKED_INDEX_MAGIC, len(header).to_bytes(8, 'little'), header, offsets.tobytes()])
+
     def __setitem__(self, key: Any, item: Any) -> None:
         """
         Add an item to the file with a specific key.
@@ -189,7 +409,7 @@ class FDD:
             raise ValueError("trying to re-insert a record with key,", key, "FDD cannot re-assign items.")
         if self.mode == 'read_mode':
             raise ValueError("trying to insert into a read-mode FDD. This is not supported.", "key=", key)
-        data = self.compressor(pkl.dumps(item))
+        data = self._dumps(item) if self._compress_skip else self.compressor(self._dumps(item))
         self.write_raw_bytes(key, data)
 
     def __getitem__(self, key: Any) -> Any:
@@ -199,8 +419,34 @@ class FDD:
         :param key: The key of the item to retrieve.
         :return: The item.
         """
-        data = self.read_raw_bytes(key)
-        return pkl.loads(self.decompressor(data))
+        offsets = self._offsets
+        if offsets is not None:
+            i = self._positions[key]
+            start = offsets[i]
+            data_len = offsets[i+1] - start
+        else:
+            start, data_len = self.index[key]
+        cache = self._cache
+        if cache is not None and start in cache:
+            cache.move_to_end(start)
+            return cache[start]
+        if self._zero_copy:
+            # unpickle straight from the map without copying the record into a bytes object first
+            with memoryview(self._mm)[start:start+data_len] as data:
+                value = pkl.loads(data)
+        else:
+            if self._mm is not None:
+                data = self._mm[start:start+data_len]
+            else:
+                self._wait_for_writes()
+                self._seek(start)
+                data = self._read(data_len)
+            value = self._loads(data) if self._compress_skip else self._loads(self.decompressor(data))
+        if cache is not None and data_len <= CACHE_MAX_RECORD_BYTES:
+            cache[start] = value
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return value
     
     def read_raw_bytes(self, key: Any) -> bytes:
         """
@@ -210,8 +456,11 @@ class FDD:
         :return: The item in byte form.
         """
         start, data_len = self.index[key]
-        self.file.seek(start)
-        data = self.file.read(data_len)
+        if self._mm is not None:
+            return self._mm[start:start+data_len]
+        self._wait_for_writes()
+        self._seek(start)
+        data = self._read(data_len)
         return data
     
     def write_raw_bytes(self, key: Any, data: bytes) -> None:
@@ -228,9 +477,14 @@ class FDD:
             raise ValueError("trying to insert into a read-mode FDD. This is not supported.", "key=", key)
         
         data_len = len(data)
-        self.file.write(data)
+        if self._writeq is not None:
+            if self._write_error is not None:
+                raise self._write_error
+            self._put_write((self.current_offset, data))
+        else:
+            self.file.write(data)
         self.index[key] = (self.current_offset, data_len)
-        self.current_offset += data_len
+        self.__dict__['current_offset'] += data_len # bypass __setattr__ in the hot path
 
     def _after_fork(self) -> None:
         """
@@ -238,8 +492,22 @@ class FDD:
         if the object is cloned to another process. For example when using PyTorch DataLoader.
         """
         # print("FDD: Reopening file after fork.")
+        if self.preload and self._mm is not None:
+            # the preloaded bytes are inherited by the child and reads never touch the file
+            return
+        if self._mm is not None:
+            self._mm.close()
         self.file.close()
         self.file = open(self.filename, 'rb+')
+        self._map_file()
+
+    def _advise(self, advice: int) -> None:
+        """
+        Passes an madvise hint for the whole map, e.g. to read ahead aggressively during a full pass.
+        Does nothing if the file is not mapped or the platform does not support the hint.
+        """
+        if advice is not None and isinstance(self._mm, mmap.mmap) and not self._mm.closed and hasattr(self._mm, 'madvise'):
+            self._mm.madvise(advice)
 
     def keys(self) -> Iterator[Any]:
         """ Return an iterator over the keys in the file. """
@@ -252,8 +520,13 @@ class FDD:
                 self.parent = parent
 
             def __iter__(self):
-                for k in self.parent.keys():
-                    yield k, self.parent[k]
+                # records are stored in key order, so a full pass reads the file front to back
+                self.parent._advise(getattr(mmap, 'MADV_SEQUENTIAL', None))
+                try:
+                    for k in self.parent.keys():
+                        yield k, self.parent[k]
+                finally:
+                    self.parent._advise(getattr(mmap, 'MADV_NORMAL', None))
 
             def __len__(self):
                 return len(self.parent.index)
@@ -1,5 +1,5 @@
 import unittest
-from efficient_index import FDDIntList, FDDIndexKeyless, FDDIndexComparableKey, FDDIndexGeneral
+from efficient_index import FDDIntList, FDDIndexKeyless, FDDIndexComparableKey, FDDIndexGeneral, FDDIndexCompact, FDDOnDiskIndex, pack_ints, pack_rows, unpack_ints
 
 class TestFDDIndex(unittest.TestCase):
     def setUp(self):
@@ -43,6 +43,122 @@ class TestFDDIndex(unittest.TestCase):
             _ = self.fdd_index_general["b"]
         with self.assertRaises(ValueError):
             self.fdd_index_general["a"] = [1, 2]  # Incorrect length
+        with self.assertRaises(OverflowError):
+            self.fdd_index_general["c"] = [1, 2, 2**48]
+        self.assertNotIn("c", self.fdd_index_general)
+        self.fdd_index_general["d"] = [4, 5, 6]
+        self.assertEqual(list(self.fdd_index_general["d"]), [4, 5, 6])
+
+    def test_copy_row_between_indices(self):
+        self.fdd_index_general["a"] = [1, 2, 3]
+        self.fdd_index_keyless[0] = self.fdd_index_general["a"]
+        self.fdd_index_general["b"] = self.fdd_index_comparable_key[20]
+        self.assertEqual(list(self.fdd_index_keyless[0]), [1, 2, 3])
+        self.assertEqual(list(self.fdd_index_general["b"]), [4, 5, 6])
+        narrow = FDDIndexGeneral(3, byte_width=4)
+        narrow["a"] = self.fdd_index_general["a"]
+        self.assertEqual(list(narrow["a"]), [1, 2, 3])
+
+    def test_pack_rows(self):
+        rows = [(1, 2, 3), (2**48 - 1, 0, 5)]
+        self.assertEqual(bytes(pack_rows(rows, 6)), b''.join(pack_ints(r, 6) for r in rows))
+        self.assertEqual(bytes(pack_rows(rows, 7)), b''.join(pack_ints(r, 7) for r in rows))
+        self.assertEqual(bytes(pack_rows(rows + [self.fdd_index_comparable_key[10]], 6)),
+                         b''.join(pack_ints(r, 6) for r in rows + [(1, 2, 3)]))
+        with self.assertRaises(OverflowError):
+            pack_rows([(2**48,)], 6)
+
+    def test_fdd_int_list_tolist(self):
+        values = [0, 1, 255, 256, 2**40 + 7]
+        for byte_width in [6, 7, 8]:
+            int_list = FDDIntList(len(values), bytearray(b'xx' + pack_ints(values, byte_width)), byte_width=byte_width, start_in_buffer=2)
+            self.assertEqual(int_list.tolist(), values)
+            self.assertEqual(list(int_list), values)
+        for byte_width in [1, 2, 3, 4, 5]:
+            fits = [v for v in values if v < 2**(8*byte_width)]
+            for count in [len(fits), 40]:
+                row = (fits * count)[:count]
+                int_list = FDDIntList(count, b'x' + pack_ints(row, byte_width), byte_width=byte_width, start_in_buffer=1)
+                self.assertEqual(int_list.tolist(), row)
+
+    def test_unpack_ints(self):
+        values = [0, 1, 255, 256, 2**40 + 7]
+        for byte_width in [1, 5, 6, 8, 9]:
+            fits = [v for v in values if v < 2**(8*byte_width)]
+            self.assertEqual(unpack_ints(pack_ints(fits, byte_width), byte_width), fits)
+        keyless = FDDIndexKeyless(2)
+        keyless[0] = (1, 2)
+        keyless[1] = (3, 4)
+        self.assertEqual(keyless.rows(), [(1, 2), (3, 4)])
+        self.assertEqual(keyless.packed_rows(), [pack_ints((1, 2), 6), pack_ints((3, 4), 6)])
+        self.assertEqual(keyless.repacked(2).packed_rows(), [pack_ints((1, 2), 2), pack_ints((3, 4), 2)])
+
+    def test_fdd_int_list_fixed_widths(self):
+        values = [0, 1, 200, 255]
+        for byte_width in [1, 2, 3, 4, 5, 6, 7, 8]:
+            int_list = FDDIntList(len(values), pack_ints(iter(values), byte_width), byte_width=byte_width)
+            self.assertEqual([int_list[i] for i in range(len(values))], values)
+            self.assertEqual(int_list[-1], 255)
+            self.assertEqual(int_list[-4], 0)
+            for out_of_bounds in [-5, 4]:
+                with self.assertRaises(IndexError):
+                    int_list[out_of_bounds]
+            with self.assertRaises(OverflowError):
+                pack_ints([256**byte_width], byte_width)
+
+    def test_fdd_int_list_span(self):
+        values = [0, 1, 200, 255]
+        for byte_width in [1, 2, 3, 4, 5, 6, 7, 8]:
+            int_list = FDDIntList(len(values), b'x' + pack_ints(values, byte_width), byte_width=byte_width, start_in_buffer=1)
+            self.assertEqual([int_list.span(i) for i in range(3)], [(0, 1), (1, 200), (200, 255)])
+            self.assertEqual(tuple(int_list.span(-2)), (200, 255))
+            with self.assertRaises(IndexError):
+                int_list.span(3)
+
+    def test_fdd_index_compact(self):
+        for key in ["a", 7, ("t", 1), None]:
+            self.fdd_index_general[key] = [len(self.fdd_index_general), 0, 0]
+        compact = FDDIndexCompact(self.fdd_index_general)
+        self.assertEqual(list(compact.keys()), list(self.fdd_index_general.keys()))
+        for key in self.fdd_index_general.keys():
+            self.assertIn(key, compact)
+            self.assertEqual(list(compact[key]), list(self.fdd_index_general[key]))
+        self.assertNotIn("b", compact)
+        self.assertNotIn([], compact)
+        with self.assertRaises(KeyError):
+            _ = compact[8]
+
+    def test_bulk_update_and_extend(self):
+        self.fdd_index_general["a"] = [1, 2, 3]
+        self.fdd_index_general.update({"a": [7, 8, 9], "b": (4, 5, 6), 10: self.fdd_index_comparable_key[10]})
+        self.assertEqual(list(self.fdd_index_general.keys()), ["a", "b", 10])
+        self.assertEqual([list(v) for v in self.fdd_index_general.values()], [[7, 8, 9], [4, 5, 6], [1, 2, 3]])
+        with self.assertRaises(ValueError):
+            self.fdd_index_general.update({"c": [1, 2]})
+        self.assertNotIn("c", self.fdd_index_general)
+
+        self.fdd_index_keyless.extend([(1, 2, 3), self.fdd_index_comparable_key[20]])
+        self.assertEqual(self.fdd_index_keyless.rows(), [(1, 2, 3), (4, 5, 6)])
+        with self.assertRaises(ValueError):
+            self.fdd_index_keyless.extend([(1, 2)])
+
+    def test_fdd_on_disk_index_iteration(self):
+        class BytesParent:
+            def __init__(self, data):
+                self.data = data
+            def read_chunk(self, start, end):
+                return self.data[start:end]
+        rows = [(i, i + 1, 2**40 + i) for i in range(10)]
+        for byte_width in [6, 8]:
+            packed = b'xx' + pack_ints([len(rows), 3, byte_width], 8) + pack_rows(rows, byte_width)
+            on_disk = FDDOnDiskIndex(BytesParent(packed), 2)
+            on_disk.BLOCK_ROWS = 3
+            self.assertEqual(list(on_disk), rows)
+            self.assertEqual(list(on_disk.items()), list(enumerate(rows)))
+            self.assertEqual(on_disk.rows(), rows)
+            self.assertEqual(list(on_disk[9]), list(rows[9]))
+            with self.assertRaises(IndexError):
+                _ = on_disk[10]
 
 if __name__ == "__main__":
     unittest.main()
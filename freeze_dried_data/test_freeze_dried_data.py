@@ -1,7 +1,22 @@
+import array
 import os
 import unittest
 import random
-from freeze_dried_data import RFDD, WFDD, add_column, FDDIndexBase
+import signal
+import sqlite3
+from freeze_dried_data import RFDD, WFDD, add_column, FDDIndexBase, FDDIndexComparableKey
+
+class SelfReferencingKey:
+    # a hashable key that refers to itself, so the index holding it is cyclic
+    def __init__(self, name):
+        self.name = name
+        self.me = self
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __eq__(self, other):
+        return isinstance(other, SelfReferencingKey) and other.name == self.name
 
 class TestFDD(unittest.TestCase):
     test_file = '/tmp/test_fdd.fdd'
@@ -210,8 +225,10 @@ class TestFDD(unittest.TestCase):
         with RFDD(self.test_file) as fdd:
             self.assertEqual(fdd.property_one, 'changed')
             self.assertEqual(fdd.property_one, 'changed') # the second time it should be loaded from the cache
+            self.assertIn('property_one', fdd.__dict__)
             self.assertEqual(fdd.property_two, 123)
             del fdd.property_one
+            self.assertNotIn('property_one', fdd.__dict__)
             with self.assertRaises(AttributeError):
                 _ = fdd.property_one
             
@@ -239,6 +256,19 @@ class TestFDD(unittest.TestCase):
             self.assertEqual(rfdd['house3'].area, 300)
             self.assertEqual(rfdd['house3'].price, 300000)
 
+    def test_self_referencing_values(self):
+        value = [1, 2]
+        value.append(value)
+        with WFDD(self.test_file, columns={'value':'any'}, overwrite=True) as wfdd:
+            wfdd['key'] = (value,)
+            wfdd[SelfReferencingKey('cyclic')] = ([3],)
+
+        with RFDD(self.test_file) as rfdd:
+            loaded = rfdd['key'].value
+            self.assertEqual(loaded[:2], [1, 2])
+            self.assertIs(loaded[2], loaded)
+            self.assertEqual(rfdd[SelfReferencingKey('cyclic')].value, [3])
+
     def test_single_column_functionality(self):
         with WFDD(self.test_file, columns={'value':'any'}, overwrite=True) as wfdd:
             wfdd['key1'].value='value1'
@@ -331,6 +361,51 @@ class TestFDD(unittest.TestCase):
             self.assertEqual(rfdd['list'], [1, 2, 3])
             self.assertEqual(rfdd['dict'], {'key': 'value'})
 
+    def test_fixed_width_int_columns(self):
+        columns = {'int8': 'int8', 'int16': 'int16', 'int32': 'int32', 'int64': 'int64', 'int': 'int', 'int128': 'int128'}
+        row = {'int8': 255, 'int16': 2**16 - 1, 'int32': 2**32 - 1, 'int64': 2**64 - 1, 'int': 0, 'int128': 2**128 - 1}
+        with WFDD(self.test_file, columns=columns, overwrite=True) as wfdd:
+            wfdd['row'] = row
+        with RFDD(self.test_file) as rfdd:
+            self.assertEqual(rfdd['row'].as_dict(), row)
+
+        # values that don't fit raise OverflowError, like int.to_bytes
+        with WFDD(self.test_file, columns=columns, overwrite=True) as wfdd:
+            for name in columns:
+                for value in [-1, 2**64 if name != 'int128' else 2**128]:
+                    with self.assertRaises(OverflowError):
+                        wfdd['row'] = {**row, name: value}
+            self.assertEqual(len(wfdd), 0)
+
+    def test_str_columns_are_utf8(self):
+        with WFDD(self.test_file, columns={'text': 'str', 'packed': 'str_compressed'}, overwrite=True) as wfdd:
+            wfdd['row'] = {'text': 'h\u00e9llo \u2603', 'packed': '\U0001f600' * 3}
+        with RFDD(self.test_file) as rfdd:
+            self.assertEqual(rfdd['row'].as_dict(), {'text': 'h\u00e9llo \u2603', 'packed': '\U0001f600' * 3})
+            start, end = rfdd.index['row'][0], rfdd.index['row'][1]
+            self.assertEqual(rfdd.read_chunk(start, end), 'h\u00e9llo \u2603'.encode('utf-8'))
+
+    def test_str_zstd_column(self):
+        texts = {f'doc{i}': f'document {i} ' * i + '\u2603' for i in range(50)}
+        with WFDD(self.test_file, columns={'text': 'str_zstd', 'length': 'int32'}, overwrite=True) as wfdd:
+            for k, text in texts.items():
+                wfdd[k] = {'text': text, 'length': len(text)}
+        with RFDD(self.test_file) as rfdd:
+            self.assertEqual({k: row.text for k, row in rfdd.items()}, texts)
+            self.assertEqual(rfdd['doc49', 'text'], texts['doc49'])
+            row_index = rfdd.index['doc49']
+            self.assertLess(row_index[1] - row_index[0], len(texts['doc49']))
+
+    def test_str_lz4_column(self):
+        texts = {f'doc{i}': f'document {i} ' * i + '\u2603' for i in range(50)}
+        with WFDD(self.test_file, columns={'text': 'str_lz4'}, overwrite=True) as wfdd:
+            for k, text in texts.items():
+                wfdd[k] = {'text': text}
+        with RFDD(self.test_file) as rfdd:
+            self.assertEqual({k: row.text for k, row in rfdd.items()}, texts)
+            row_index = rfdd.index['doc49']
+            self.assertLess(row_index[1] - row_index[0], len(texts['doc49']))
+
     def test_overwrite_existing_file(self):
         # Create a file and then overwrite it
         with WFDD(self.test_file, overwrite=True) as wfdd:
@@ -538,6 +613,20 @@ class TestFDD(unittest.TestCase):
                 
 
 
+    def test_split_filter(self):
+        with WFDD(self.test_file, columns={'name':'str','area':'any'}, overwrite=True) as wfdd:
+            for i in range(20):
+                wfdd[f'house_{i}'] = {'name': f'house_{i}', 'area': 100+10*i}
+            wfdd.make_split('odds', [f'house_{i}' for i in range(1,20,2)])
+            wfdd.make_split('evens', [f'house_{i}' for i in range(0,20,2)])
+
+        for _ in range(2):
+            with RFDD(self.test_file, split='odds+evens$r.area >= 250') as rfdd:
+                self.assertEqual(sorted(rfdd.keys(), key=lambda k: int(k.split('_')[1])), [f'house_{i}' for i in range(15, 20)])
+        with RFDD(self.test_file, split='odds+evens') as rfdd:
+            self.assertEqual(list(rfdd.keys()), [f'house_{i}' for i in range(1,20,2)] + [f'house_{i}' for i in range(0,20,2)])
+            self.assertEqual(rfdd['house_4'].area, 140)
+
     def test_large_data_handling(self):
         num_records = 1000
         data = {f'key{i}': f'value{i}' for i in range(num_records)}
@@ -566,6 +655,46 @@ class TestFDD(unittest.TestCase):
             for key, value in data.items():
                 self.assertEqual(rfdd[key], value)
 
+    def test_unordered_splits(self):
+        with WFDD(self.test_file, columns={'name':'str','area':'any'}, overwrite=True) as wfdd:
+            for i in range(20):
+                wfdd[f'house_{i:02}'] = {'name': f'house_{i:02}', 'area': i}
+            wfdd.make_split('sorted', [f'house_{i:02}' for i in range(19, -1, -3)], preserve_order=False)
+            wfdd.make_split('empty', [], preserve_order=False)
+            wfdd.make_split('big', lambda r: r.area >= 15)
+            wfdd.add_to_split('big', ['house_01', 'house_16'])
+            with self.assertRaises(KeyError):
+                wfdd.make_split('missing', ['house_99'], preserve_order=False)
+
+        with RFDD(self.test_file, split='sorted') as rfdd:
+            self.assertIsInstance(rfdd.index, FDDIndexComparableKey)
+            self.assertEqual(list(rfdd.keys()), [f'house_{i:02}' for i in sorted(range(19, -1, -3))])
+            self.assertEqual(rfdd['house_07'].area, 7)
+        with RFDD(self.test_file, split='empty') as rfdd:
+            self.assertEqual(len(rfdd), 0)
+        with RFDD(self.test_file, split='big') as rfdd:
+            self.assertEqual(sorted(rfdd.keys()), ['house_01'] + [f'house_{i}' for i in range(15, 20)])
+
+    def test_partial_and_mixed_rows(self):
+        with WFDD(self.test_file, columns={'name':'str','area':'any', 'price':'any'}, overwrite=True) as wfdd:
+            wfdd['house1'] = {'name': 'house1', 'area': 100, 'price': None}
+            wfdd['house2'] = {'name': 'house2', 'price': 200000}
+            wfdd['house3'] = ('house3', None, 300000)
+            with self.assertRaises(ValueError):
+                wfdd['house4'] = {'name': 'house4', 'area': 400, 'extra': 1}
+            with self.assertRaises(ValueError):
+                wfdd['house4'] = ('house4', 400)
+
+        with RFDD(self.test_file) as rfdd:
+            self.assertEqual(rfdd['house1'].as_dict(), {'name': 'house1', 'area': 100, 'price': None})
+            self.assertEqual(rfdd['house2'].as_dict(), {'name': 'house2', 'area': None, 'price': 200000})
+            self.assertEqual(rfdd['house3'].as_dict(), {'name': 'house3', 'area': None, 'price': 300000})
+            self.assertNotIn('house4', rfdd)
+            row = rfdd['house2']
+            row['price'] = 5
+            self.assertIsNone(row.area)
+            self.assertEqual(row.as_dict(), {'name': 'house2', 'area': None, 'price': 5})
+
     def test_column_not_found(self):
         with WFDD(self.test_file, columns={'name':'str','area':'any', 'price':'any'}, overwrite=True) as wfdd:
             wfdd['house1'] = {'name': 'house1', 'area': 100, 'price': 100000}
@@ -605,6 +734,17 @@ class TestFDD(unittest.TestCase):
             wfdd['key1']= 'value1'
             with self.assertRaises(KeyError):
                 _ = wfdd['key2']
+        with RFDD(self.test_file) as rfdd:
+            with self.assertRaises(KeyError) as cm:
+                _ = rfdd['key2']
+            self.assertEqual(cm.exception.args, ('Key not found.', 'key2', ['key1']))
+        with WFDD(self.test_file, overwrite=True) as wfdd:
+            for i in range(100):
+                wfdd[i] = i
+        with RFDD(self.test_file) as rfdd:
+            with self.assertRaises(KeyError) as cm:
+                _ = rfdd[100]
+            self.assertEqual(cm.exception.args, ('Key not found.', 100, 100))
 
     def test_key_already_exists(self):
         with WFDD(self.test_file, overwrite=True) as wfdd:
@@ -812,6 +952,70 @@ class TestFDD(unittest.TestCase):
                     self.assertTrue(torch.allclose(rfdd[k].tensor, v['tensor']))
                     self.assertEqual(rfdd[k].label, v['label'])
 
+    def test_numpy_column(self):
+        import numpy as np
+        data = {'a': np.arange(12, dtype='<f4').reshape(3, 4),
+                'b': np.zeros((0, 3), dtype='i2'),
+                'c': np.array(5, dtype='>i8'),
+                'd': np.arange(6).reshape(2, 3).T}
+        with WFDD(self.test_file, columns={'array': 'numpy', 'label': 'str'}, overwrite=True) as wfdd:
+            for k, v in data.items():
+                wfdd[k] = {'array': v, 'label': k}
+
+        with RFDD(self.test_file) as rfdd:
+            for k, v in data.items():
+                self.assertEqual(rfdd[k].array.dtype, v.dtype)
+                self.assertEqual(rfdd[k].array.shape, v.shape)
+                self.assertTrue((rfdd[k].array == v).all())
+                self.assertEqual(rfdd[k].label, k)
+
+    def test_column_array(self):
+        with WFDD(self.test_file, columns={'a': 'int32', 'b': 'int', 'c': 'any'}, overwrite=True) as wfdd:
+            for i in range(100):
+                wfdd[f'key{i}'] = (i, 2**40 + i, str(i))
+            wfdd['missing'].c = 'no ints'
+            wfdd.make_split('odds', [f'key{i}' for i in range(1, 100, 2)], keyless=True)
+
+        with RFDD(self.test_file) as rfdd:
+            self.assertEqual(rfdd.column_array('a', keys=[f'key{i}' for i in range(100)]).tolist(), list(range(100)))
+            self.assertEqual(rfdd.column_array('b', keys=['key7', 'key3']).tolist(), [2**40 + 7, 2**40 + 3])
+            self.assertEqual(rfdd.column_array('a', keys=[]).tolist(), [])
+            with self.assertRaises(ValueError):
+                rfdd.column_array('a')
+            with self.assertRaises(ValueError):
+                rfdd.column_array('c', keys=['key0'])
+            with self.assertRaises(KeyError):
+                rfdd.column_array('d')
+        with RFDD(self.test_file, split='odds') as rfdd:
+            self.assertEqual(rfdd.column_array('a').tolist(), list(range(1, 100, 2)))
+
+    def test_torch_column(self):
+        import torch
+        data = {'a': torch.randn(3, 4, dtype=torch.bfloat16),
+                'b': torch.zeros((0, 3), dtype=torch.int16),
+                'c': torch.tensor(5),
+                'd': torch.arange(6).reshape(2, 3).T,
+                'e': torch.tensor([True, False])}
+        with WFDD(self.test_file, columns={'tensor': 'torch', 'label': 'str'}, overwrite=True) as wfdd:
+            for k, v in data.items():
+                wfdd[k] = {'tensor': v, 'label': k}
+
+        with RFDD(self.test_file) as rfdd:
+            for k, v in data.items():
+                self.assertEqual(rfdd[k].tensor.dtype, v.dtype)
+                self.assertEqual(rfdd[k].tensor.shape, v.shape)
+                self.assertTrue(torch.equal(rfdd[k].tensor, v))
+                self.assertEqual(rfdd[k].label, k)
+
+        images = torch.randn(2, 3, 4, 5)
+        with WFDD(self.test_file, columns={'images': 'torch_channels_last'}, overwrite=True) as wfdd:
+            wfdd['batch'] = {'images': images}
+        with RFDD(self.test_file) as rfdd:
+            stored = rfdd['batch'].images
+            self.assertEqual(stored.shape, images.shape)
+            self.assertTrue(stored.is_contiguous(memory_format=torch.channels_last))
+            self.assertTrue(torch.equal(stored, images))
+
     def test_row_has_already_been_finalized(self):
         with WFDD(self.test_file,columns={'col1':'any','col2':'any'},overwrite=True) as wfdd:
             wfdd['key1'].col1 = 1
@@ -996,19 +1200,75 @@ class TestFDD(unittest.TestCase):
 
         with RFDD(self.test_file, allow_cell_modification=True) as rfdd:
             rfdd['house1'].area=99
+            # the change is visible to later reads of the same RFDD
+            self.assertEqual(rfdd['house1', 'area'], 99)
 
         with RFDD(self.test_file, allow_cell_modification=True) as rfdd:
             print(rfdd['house1'])
+            self.assertEqual(rfdd['house1'].area, 99)
 
         with WFDD(self.test_file, allow_cell_modification=True, reopen=True) as wfdd:
             wfdd['house2'].area=199
 
         with RFDD(self.test_file, allow_cell_modification=True) as rfdd:
             print(rfdd['house2'])
+            self.assertEqual(rfdd['house2'].area, 199)
+
+        # a setter that is still held after its row was finalized overwrites the cell in place
+        with WFDD(self.test_file, columns={'a':'int32','b':'bytes'}, overwrite=True, allow_cell_modification=True) as wfdd:
+            setter = wfdd['row']
+            setter.a = 1
+            setter.b = b'xy'
+            setter.a = 5
+            with self.assertRaises(ValueError):
+                setter.b = b'too long'
+            with self.assertRaises(AttributeError):
+                setter.c = 3
+        with RFDD(self.test_file) as rfdd:
+            self.assertEqual(rfdd['row'].as_dict(), {'a': 5, 'b': b'xy'})
+
+        with WFDD(self.test_file, columns={'a':'int32','b':'bytes'}, overwrite=True) as wfdd:
+            for i in range(4):
+                wfdd[i] = (i, b'%d' % i)
+        with RFDD(self.test_file, allow_cell_modification=True) as rfdd:
+            self.assertEqual(rfdd[1].b, b'1')
+            rfdd.modify_cells([(2, 'b', b'x'), (1, 'a', 10), (1, 'b', b'y'), (3, 'a', 30), (3, 'a', 31)])
+            self.assertEqual([tuple(rfdd[i].values()) for i in range(4)], [(0, b'0'), (10, b'y'), (2, b'x'), (31, b'3')])
+            with self.assertRaises(AttributeError):
+                rfdd.modify_cells([(0, 'c', 1)])
+            with self.assertRaises(ValueError):
+                rfdd.modify_cells([(0, 'a', 1), (0, 'b', b'too long')])
+            self.assertEqual(tuple(rfdd[0].values()), (0, b'0'))
+        with RFDD(self.test_file) as rfdd:
+            self.assertEqual(rfdd[3].a, 31)
+            with self.assertRaises(AttributeError):
+                rfdd.modify_cells([(0, 'a', 1)])
+
+        cache_path = '/tmp/test_fdd_cache.sqlite'
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        with RFDD(self.test_file, allow_cell_modification=True, cache_path=cache_path) as rfdd:
+            self.assertEqual(rfdd[1].b, b'y')
+            rfdd.modify_cells([(1, 'b', b'z')])
+            self.assertEqual(rfdd[1].b, b'z')
+        os.remove(cache_path)
 
-            
 
 
+
+    def test_pickle_rfdd(self):
+        import pickle as pkl
+        with WFDD(self.test_file, overwrite=True) as wfdd:
+            wfdd['hello'] = 'world'
+            wfdd['number'] = 123
+
+        with RFDD(self.test_file) as rfdd:
+            rfdd_copy = pkl.loads(pkl.dumps(rfdd))
+
+        self.assertEqual(rfdd_copy['hello'], 'world')
+        self.assertEqual(rfdd_copy['number'], 123)
+        rfdd_copy.close()
+
     def test_reopen_file_without_columns(self):
         data = {f'key{i}': {'name': f'name{i}', 'area': random.random(), 'price': random.random()} for i in range(1000)}
         with WFDD(self.test_file, columns={'name':'str','area':'any', 'price':'any'}, overwrite=True) as wfdd:
@@ -1095,6 +1355,338 @@ class TestFDD(unittest.TestCase):
             self.assertEqual(rfdd['house2'].as_dict(), {'name': 'house2', 'area': 200, 'price': 200000})
             self.assertEqual(rfdd['house3'].as_dict(), {'name': 'house3', 'area': 300, 'price': 300000})
 
+    def test_getmany(self):
+        with WFDD(self.test_file, overwrite=True) as wfdd:
+            for i in range(10):
+                wfdd[f'key{i}'] = i
+
+        with RFDD(self.test_file) as rfdd:
+            self.assertEqual(rfdd.getmany(['key7', 'key2', 'key9']), [7, 2, 9])
+            with self.assertRaises(KeyError):
+                rfdd.getmany(['key1', 'does_not_exist'])
+
+        with WFDD(self.test_file, columns={'name':'str','area':'any'}, overwrite=True) as wfdd:
+            wfdd['house1'] = {'name': 'house1', 'area': 100}
+            wfdd['house2'] = {'name': 'house2', 'area': 200}
+
+        with RFDD(self.test_file) as rfdd:
+            rows = rfdd.getmany(['house2', 'house1'])
+            self.assertEqual([r.as_dict() for r in rows], [{'name': 'house2', 'area': 200}, {'name': 'house1', 'area': 100}])
+
+    def test_iter_prefetch(self):
+        data = {f'key{i}': 'x' * i for i in range(1000)}
+        with WFDD(self.test_file, overwrite=True) as wfdd:
+            for k, v in data.items():
+                wfdd[k] = v
+
+        with RFDD(self.test_file) as rfdd:
+            self.assertEqual(dict(rfdd.iter_prefetch(depth=7)), data)
+            self.assertEqual(list(rfdd.iter_prefetch(['key3', 'key1'])), [('key3', 'xxx'), ('key1', 'x')])
+            self.assertEqual(dict(rfdd.items()), data)
+            self.assertEqual(dict(rfdd.items(prefetch=7)), data)
+            unfinished = iter(rfdd.items())
+            self.assertEqual(next(unfinished), ('key0', ''))
+        # finishing the iteration after the file is closed must not fail
+        unfinished.close()
+
+    def test_iterate_in_slabs(self):
+        data = {f'key{i}': 'x' * i for i in range(300)}
+        with WFDD(self.test_file, overwrite=True) as wfdd:
+            for k, v in data.items():
+                wfdd[k] = v
+        with WFDD(self.test_file2, columns={'name': 'str', 'area': 'any', 'empty': 'any'}, overwrite=True) as wfdd:
+            for i in range(300):
+                wfdd[f'house{i}'] = {'name': f'house{i}', 'area': i}
+            wfdd.make_split('odd', [f'house{i}' for i in range(299, 0, -2)])
+
+        with RFDD(self.test_file) as rfdd:
+            for prefetch_bytes in [1, 1000, 1 << 20]:
+                self.assertEqual(list(rfdd.iterate(prefetch_bytes)), list(data.items()))
+        with RFDD(self.test_file2) as rfdd:
+            rows = [(k, row.as_dict()) for k, row in rfdd.iterate(500)]
+            self.assertEqual(rows, [(f'house{i}', {'name': f'house{i}', 'area': i, 'empty': None}) for i in range(300)])
+        with RFDD(self.test_file2, split='odd') as rfdd:
+            self.assertEqual([row.area for _, row in rfdd.iterate()], list(range(299, 0, -2)))
+
+    def test_items_reuse_row(self):
+        with WFDD(self.test_file, columns={'name':'str','area':'any'}, overwrite=True) as wfdd:
+            for i in range(10):
+                wfdd[f'house{i}'] = {'name': f'house{i}', 'area': i}
+
+        with RFDD(self.test_file) as rfdd:
+            rows = [(k, r.area) for k, r in rfdd.items(reuse_row=True)]
+            self.assertEqual(rows, [(f'house{i}', i) for i in range(10)])
+            self.assertEqual(len({id(r) for _, r in rfdd.items(reuse_row=True)}), 1)
+            self.assertEqual([r.name for _, r in rfdd.items()], [f'house{i}' for i in range(10)])
+            self.assertEqual([(k, r.area) for k, r in rfdd.items(prefetch=3)], rows)
+            self.assertEqual([(k, r.area) for k, r in rfdd.items(reuse_row=True, prefetch=4)], rows)
+
+    def test_read_row_reuse(self):
+        with WFDD(self.test_file, columns={'name':'str','area':'any'}, overwrite=True) as wfdd:
+            for i in range(10):
+                wfdd[f'house{i}'] = {'name': f'house{i}', 'area': i}
+
+        with RFDD(self.test_file, read_row_reuse=True) as rfdd:
+            first = rfdd['house0']
+            self.assertEqual(first.area, 0)
+            self.assertIs(rfdd['house3'], first)
+            self.assertEqual(first.as_dict(), {'name': 'house3', 'area': 3})
+            self.assertEqual([rfdd[f'house{i}'].area for i in range(10)], list(range(10)))
+        with RFDD(self.test_file) as rfdd:
+            self.assertIsNot(rfdd['house0'], rfdd['house1'])
+
+    def test_read_row_cache_size(self):
+        with WFDD(self.test_file, columns={'name':'str','area':'any'}, overwrite=True) as wfdd:
+            for i in range(10):
+                wfdd[f'house{i}'] = {'name': f'house{i}', 'area': i}
+
+        with RFDD(self.test_file, read_row_cache_size=2) as rfdd:
+            house0, house1 = rfdd['house0'], rfdd['house1']
+            self.assertIs(rfdd['house0'], house0)
+            self.assertIs(rfdd['house1'], house1)
+            # house0 is now the least recently used row
+            rfdd['house2']
+            self.assertIs(rfdd['house1'], house1)
+            self.assertIsNot(rfdd['house0'], house0)
+            rfdd.load_keys(lambda row: row.area)
+            self.assertEqual(rfdd[0].name, 'house0')
+
+    def test_random_access(self):
+        with WFDD(self.test_file, columns={'name':'str','area':'any'}, overwrite=True) as wfdd:
+            for i in range(10):
+                wfdd[f'house{i}'] = {'name': f'house{i}', 'area': i}
+
+        with RFDD(self.test_file, random_access=True) as rfdd:
+            self.assertEqual([rfdd[f'house{i}'].area for i in (7, 2, 9)], [7, 2, 9])
+            self.assertEqual([row.area for _, row in rfdd.items()], list(range(10)))
+            import pickle as pkl
+            unpickled = pkl.loads(pkl.dumps(rfdd))
+            self.assertEqual(unpickled['house4'].as_dict(), {'name': 'house4', 'area': 4})
+            unpickled.close()
+
+        # a slab pass reads ahead while it runs, then puts back the advice for lookups
+        if hasattr(os, 'posix_fadvise'):
+            posix_fadvise = os.posix_fadvise
+            advice = []
+            os.posix_fadvise = lambda fd, offset, length, hint: advice.append(hint)
+            try:
+                for random_access, lookups in [(True, os.POSIX_FADV_RANDOM), (False, os.POSIX_FADV_NORMAL)]:
+                    advice.clear()
+                    with RFDD(self.test_file, random_access=random_access) as rfdd:
+                        self.assertEqual([row.area for _, row in rfdd.iterate()], list(range(10)))
+                    self.assertEqual(advice, [os.POSIX_FADV_SEQUENTIAL, lookups])
+            finally:
+                os.posix_fadvise = posix_fadvise
+
+    def test_disk_cache(self):
+        cache_path = '/tmp/test_fdd_cache.sqlite'
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        with WFDD(self.test_file, columns={'name':'str','area':'any'}, overwrite=True) as wfdd:
+            wfdd['house1'] = {'name': 'house1', 'area': 100}
+            wfdd['house2'] = {'name': 'house2', 'area': 200}
+            wfdd.description = 'houses'
+
+        with RFDD(self.test_file, cache_path=cache_path) as rfdd:
+            self.assertEqual(rfdd['house1'].as_dict(), {'name': 'house1', 'area': 100})
+            self.assertEqual(rfdd['house2', 'name'], 'house2')
+            self.assertEqual(rfdd.description, 'houses')
+
+        # the second time everything is served from the cache without touching the file
+        with RFDD(self.test_file, cache_path=cache_path) as rfdd:
+            def no_reads(start, end):
+                raise AssertionError('read from file', start, end)
+            rfdd.read_chunk = no_reads
+            self.assertEqual(rfdd['house1'].as_dict(), {'name': 'house1', 'area': 100})
+            self.assertEqual(rfdd['house2', 'name'], 'house2')
+            self.assertEqual(rfdd.description, 'houses')
+            del rfdd.read_chunk
+
+        # rewriting the file must not serve stale values
+        with WFDD(self.test_file, columns={'name':'str','area':'any'}, overwrite=True) as wfdd:
+            wfdd['house1'] = {'name': 'house3', 'area': 300}
+        with RFDD(self.test_file, cache_path=cache_path) as rfdd:
+            self.assertEqual(rfdd['house1'].as_dict(), {'name': 'house3', 'area': 300})
+        # and the values cached for the old contents are dropped
+        with sqlite3.connect(cache_path) as connection:
+            sources = connection.execute('SELECT DISTINCT source FROM fdd_cache').fetchall()
+        connection.close()
+        self.assertEqual(len(sources), 1)
+
+        # nor overwriting a cell in place through the reader that cached it
+        with RFDD(self.test_file, allow_cell_modification=True, cache_path=cache_path) as rfdd:
+            self.assertEqual(rfdd['house1'].area, 300)
+            rfdd['house1'].area = 301
+            rfdd.read_row_cache = None
+            self.assertEqual(rfdd['house1'].area, 301)
+        os.remove(cache_path)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_reads_after_fork(self):
+        cache_path = '/tmp/test_fdd_cache.sqlite'
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        with WFDD(self.test_file, columns={'name':'str','area':'any'}, overwrite=True) as wfdd:
+            wfdd['house1'] = {'name': 'house1', 'area': 100}
+
+        with RFDD(self.test_file, cache_path=cache_path) as rfdd:
+            self.assertEqual(rfdd['house1', 'area'], 100)
+            parent_pool = rfdd.get_deserialize_pool()
+            parent_pool.submit(int).result()
+            pid = os.fork()
+            if pid == 0:
+                # the parent's pool threads and sqlite connection must not be used here
+                signal.alarm(10)
+                ok = (rfdd.get_deserialize_pool() is not parent_pool
+                      and rfdd.get_deserialize_pool().submit(int, '7').result() == 7
+                      and rfdd['house1'].as_dict() == {'name': 'house1', 'area': 100})
+                os._exit(0 if ok else 1)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+            self.assertIs(rfdd.get_deserialize_pool(), parent_pool)
+        os.remove(cache_path)
+
+    def test_index_compression(self):
+        with WFDD(self.test_file, overwrite=True) as wfdd:
+            for i in range(1000):
+                wfdd[f'key{i}'] = i
+        uncompressed_size = os.path.getsize(self.test_file)
+
+        with WFDD(self.test_file, index_compression='zlib', overwrite=True) as wfdd:
+            for i in range(1000):
+                wfdd[f'key{i}'] = i
+            wfdd.make_split('even', [f'key{i}' for i in range(0, 1000, 2)])
+        self.assertLess(os.path.getsize(self.test_file), uncompressed_size)
+
+        with RFDD(self.test_file, split='even') as rfdd:
+            self.assertEqual(len(rfdd), 500)
+            self.assertEqual(rfdd['key998'], 998)
+
+        with WFDD(self.test_file, reopen=True) as wfdd:
+            wfdd['key1000'] = 1000
+            # a split that is not written to is never loaded
+            self.assertIs(type(wfdd.split_to_index['even']), bytes)
+            self.assertEqual(wfdd.index_compression, 'zlib')
+        with open(self.test_file, 'rb') as f:
+            f.seek(-8, 2)
+            index_index_size = int.from_bytes(f.read(8), 'little')
+            f.seek(-(8 + index_index_size), 2)
+            # the index is still compressed after a reopen
+            self.assertEqual(f.read(4), b'FDDz')
+        with RFDD(self.test_file) as rfdd:
+            self.assertEqual(len(rfdd), 1001)
+        with RFDD(self.test_file, split='even') as rfdd:
+            self.assertEqual(len(rfdd), 500)
+
+        with WFDD(self.test_file, reopen=True) as wfdd:
+            wfdd.add_to_split('even', ['key1000'])
+        with RFDD(self.test_file, split='even') as rfdd:
+            self.assertEqual(len(rfdd), 501)
+            self.assertEqual(rfdd['key1000'], 1000)
+
+        with self.assertRaises(ValueError):
+            WFDD(self.test_file2, index_compression='lzma')
+
+    def test_narrow_keyless_index(self):
+        with WFDD(self.test_file, overwrite=True) as wfdd:
+            for i in range(100):
+                wfdd[f'key{i}'] = i
+            wfdd.make_split('small', [f'key{i}' for i in range(10)], keyless=True)
+
+        with WFDD(self.test_file, reopen=True) as wfdd:
+            wfdd['big'] = b'x' * 70000
+            wfdd.make_split('large', ['key0', 'big'], keyless=True)
+            wfdd.make_split('all_rows', wfdd.keys(), keyless=True, overwrite=True)
+
+        with RFDD(self.test_file, split='small') as rfdd:
+            self.assertEqual(rfdd.index.byte_width, 1)
+            self.assertEqual([rfdd[i] for i in range(len(rfdd))], list(range(10)))
+        with RFDD(self.test_file, split='large') as rfdd:
+            self.assertEqual(rfdd.index.byte_width, 3)
+            self.assertEqual(rfdd[1], b'x' * 70000)
+        with RFDD(self.test_file, split='small+large') as rfdd:
+            self.assertEqual(len(rfdd), 11)
+            self.assertEqual(rfdd[10], b'x' * 70000)
+
+        with WFDD(self.test_file, reopen=True) as wfdd:
+            self.assertEqual(wfdd.index.byte_width, 6)
+            wfdd[101] = b'y' * 70000
+        with RFDD(self.test_file) as rfdd:
+            self.assertEqual(len(rfdd), 102)
+            self.assertEqual(rfdd[101], b'y' * 70000)
+
+    def test_compact_index(self):
+        with WFDD(self.test_file, columns={'value': 'any'}, overwrite=True) as wfdd:
+            for i in range(100):
+                wfdd[f'key{i}'] = {'value': i}
+            wfdd.make_split('reversed', [f'key{i}' for i in range(99, -1, -1)], preserve_order=True)
+
+        with RFDD(self.test_file, split='reversed') as rfdd:
+            rfdd.compact_index()
+            self.assertEqual(type(rfdd.index).__name__, 'FDDIndexCompact')
+            self.assertEqual(len(rfdd), 100)
+            self.assertEqual(rfdd['key42'].value, 42)
+            self.assertNotIn('key100', rfdd)
+            self.assertEqual([k for k, _ in rfdd.items()], [f'key{i}' for i in range(99, -1, -1)])
+            with self.assertRaises(KeyError):
+                rfdd['key100']
+
+    def test_lazy_splits_and_cached_index(self):
+        cache_path = '/tmp/test_fdd_cache.sqlite'
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        with WFDD(self.test_file, overwrite=True) as wfdd:
+            for i in range(100):
+                wfdd[f'key{i}'] = i
+            wfdd.make_split('even', [f'key{i}' for i in range(0, 100, 2)])
+            wfdd.make_split('odd', [f'key{i}' for i in range(1, 100, 2)], keyless=True)
+            wfdd.description = 'numbers'
+
+        with RFDD(self.test_file, lazy_splits=True) as rfdd:
+            self.assertEqual(rfdd.description, 'numbers')
+            self.assertIsNone(rfdd._index)
+            self.assertEqual(len(rfdd), 100)
+            self.assertEqual(rfdd['key42'], 42)
+
+        # rows of an index read from the file stay valid after the file is closed
+        with RFDD(self.test_file, split='odd', lazy_splits=True) as rfdd:
+            self.assertEqual(rfdd[21], 43)
+            row_index = rfdd.index[21]
+            offsets = list(row_index)
+        self.assertEqual(list(row_index), offsets)
+
+        for _ in range(2):
+            with RFDD(self.test_file, split='even', cache_path=cache_path) as rfdd:
+                self.assertEqual(len(rfdd), 50)
+                self.assertEqual(rfdd['key42'], 42)
+                self.assertNotIn('key43', rfdd)
+        os.remove(cache_path)
+
+    def test_materialize_parallel(self):
+        columns = {f'col{i}': 'any' for i in range(4)}
+        row = {f'col{i}': bytes([i]) * 100000 for i in range(4)}
+        with WFDD(self.test_file, columns=columns, overwrite=True) as wfdd:
+            wfdd['big'] = row
+            wfdd['small'] = {k: i for i, k in enumerate(columns)}
+
+        with RFDD(self.test_file) as rfdd:
+            big = rfdd['big']
+            big.materialize()
+            self.assertEqual(big.as_dict(), row)
+            self.assertIsNotNone(rfdd.deserialize_pool)
+            self.assertEqual(rfdd['small'].as_dict(), {k: i for i, k in enumerate(columns)})
+        self.assertIsNone(rfdd.deserialize_pool)
+
+        # cells that can't be decoded from a view still come back as str and bytes
+        mixed = {'text': 'x' * 10000, 'raw': b'y' * 10000, 'obj': list(range(5000))}
+        with WFDD(self.test_file, columns={'text': 'str', 'raw': 'bytes', 'obj': 'any'}, overwrite=True) as wfdd:
+            wfdd['mixed'] = mixed
+        with RFDD(self.test_file) as rfdd:
+            row = rfdd['mixed']
+            row.materialize(parallel=False)
+            self.assertEqual(row.as_dict(), mixed)
+            self.assertIs(type(row.raw), bytes)
+
     def test_read_row_features(self):
         with WFDD(self.test_file, columns={'name':'str','area':'any', 'price':'any'}, overwrite=True) as wfdd:
             wfdd['house1'] = {'name': 'house1', 'area': 100, 'price': 100000}
@@ -1115,7 +1707,104 @@ class TestFDD(unittest.TestCase):
             for v in rfdd['house1'].values():
                 self.assertIn(v, ['house1', 100, 100000])
 
+    def test_read_row_iteration_reads_once(self):
+        with WFDD(self.test_file, columns={'name':'str','area':'any', 'price':'any'}, overwrite=True) as wfdd:
+            wfdd['house1'] = {'name': 'house1', 'area': 100, 'price': 100000}
 
+        with RFDD(self.test_file) as rfdd:
+            reads = []
+            read_chunk = rfdd.read_chunk
+            def counting_read_chunk(start, end):
+                reads.append((start, end))
+                return read_chunk(start, end)
+            rfdd.read_chunk = counting_read_chunk
+            self.assertEqual(list(rfdd['house1'].items()), [('name', 'house1'), ('area', 100), ('price', 100000)])
+            self.assertEqual(len(reads), 1)
+            reads.clear()
+            self.assertEqual(list(rfdd['house1'].values()), ['house1', 100, 100000])
+            self.assertLessEqual(len(reads), 1)
+            del rfdd.read_chunk
+
+    def test_large_cells_read_from_map(self):
+        big = list(range(5000))
+        columns = {'data':'any', 'text':'str', 'packed':'str_compressed', 'raw':'bytes'}
+        with WFDD(self.test_file, columns=columns, overwrite=True) as wfdd:
+            wfdd['row'] = {'data': big, 'text': 'x' * 10000, 'packed': 'y' * 100000, 'raw': b'z' * 10000}
+        with WFDD(self.test_file2, overwrite=True) as wfdd:
+            wfdd['row'] = big
+
+        rfdd = RFDD(self.test_file)
+        row = rfdd['row']
+        self.assertEqual(row.data, big)
+        self.assertEqual(row.text, 'x' * 10000)
+        self.assertEqual(row.packed, 'y' * 100000)
+        self.assertEqual(row.raw, b'z' * 10000)
+        self.assertEqual(rfdd['row', 'data'], big)
+        # no view of the map may outlive the read
+        rfdd.close()
+        with RFDD(self.test_file2) as rfdd:
+            self.assertEqual(rfdd['row'], big)
+
+    def test_read_row_by_column_name(self):
+        with WFDD(self.test_file, columns={'name':'str','area':'any'}, overwrite=True) as wfdd:
+            wfdd['house1'] = {'name': 'house1', 'area': 100}
+            row = wfdd['house1']
+            self.assertEqual((row['name'], row.area), ('house1', 100))
+            row['area'] = 5
+            self.assertEqual(row[1], 5)
+            with self.assertRaises(AttributeError):
+                row.nonexistent
+
+        with RFDD(self.test_file) as rfdd:
+            row = rfdd['house1']
+            self.assertEqual((row['name'], row.area, row[1]), ('house1', 100, 100))
+            with self.assertRaises(AttributeError):
+                row.nonexistent
+
+    def test_read_row_none_values(self):
+        with WFDD(self.test_file, columns={'name':'str','area':'any', 'price':'any'}, overwrite=True) as wfdd:
+            wfdd['house1'] = {'name': 'house1', 'area': None, 'price': 100000}
+            wfdd['house2'] = {'name': 'house2', 'area': 200, 'price': 200000}
+
+        with RFDD(self.test_file) as rfdd, WFDD(self.test_file2, columns={'name':'str','area':'any', 'price':'any'}, overwrite=True) as wfdd:
+            row = rfdd['house1']
+            self.assertIsNone(row.area)
+            self.assertIsNone(row.area)
+            wfdd['house1'] = row
+            row = rfdd['house2']
+            row['price'] = None
+            wfdd['house2'] = row
+
+        with RFDD(self.test_file2) as rfdd:
+            self.assertEqual(rfdd['house1'].as_dict(), {'name': 'house1', 'area': None, 'price': 100000})
+            self.assertEqual(rfdd['house2'].as_dict(), {'name': 'house2', 'area': 200, 'price': None})
+
+        # cells that are None or buffers other than bytes, written through the generated row writers
+        columns = {'name':'str', 'area':'any', 'data':(lambda v: memoryview(array.array('i', v)), lambda b: array.array('i', b).tolist())}
+        with WFDD(self.test_file, columns=columns, overwrite=True) as wfdd:
+            wfdd['house1'] = ('house1', None, [1, 2, 3])
+            wfdd['house2'] = {'name': None, 'area': 200, 'data': [4]}
+        with RFDD(self.test_file) as rfdd:
+            self.assertEqual(rfdd['house1'].as_dict(), {'name': 'house1', 'area': None, 'data': [1, 2, 3]})
+            self.assertEqual(rfdd['house2'].as_dict(), {'name': None, 'area': 200, 'data': [4]})
+
+    def test_copy_large_rows(self):
+        columns = {'name':'str','data':'bytes'}
+        with WFDD(self.test_file, columns=columns, overwrite=True) as wfdd:
+            for i in range(1, 5):
+                wfdd[f'row{i}'] = {'name': f'row{i}', 'data': bytes([i]) * (100000 * i)}
+
+        with RFDD(self.test_file) as rfdd, WFDD(self.test_file2, columns=columns, overwrite=True) as wfdd:
+            wfdd['small'] = {'name': 'small', 'data': b'123'}
+            for k, row in rfdd.items():
+                wfdd[k] = row
+            wfdd['after'] = {'name': 'after', 'data': b'456'}
+
+        with RFDD(self.test_file2) as rfdd:
+            self.assertEqual(rfdd['small'].as_dict(), {'name': 'small', 'data': b'123'})
+            for i in range(1, 5):
+                self.assertEqual(rfdd[f'row{i}'].as_dict(), {'name': f'row{i}', 'data': bytes([i]) * (100000 * i)})
+            self.assertEqual(rfdd['after'].as_dict(), {'name': 'after', 'data': b'456'})
 
     def test_alternative_indices(self):
         for index_type in [(False, False), (True, False), (False, True), (True, True)]:
@@ -1238,6 +1927,16 @@ class TestFDD(unittest.TestCase):
         with self.assertRaises(ValueError):
             add_column(self.test_file3, self.test_file4, 'price', new_col)
 
+        # rows big enough to be copied by the kernel
+        blobs = {f'blob_{i}': os.urandom(100000 + i) for i in range(3)}
+        with WFDD(self.test_file, columns={'data':'bytes'}, overwrite=True) as wfdd:
+            for key, blob in blobs.items():
+                wfdd[key] = {'data': blob}
+        add_column(self.test_file, self.test_file4, 'size', {key: len(blob) for key, blob in blobs.items()}, overwrite=True)
+        with RFDD(self.test_file4) as rfdd:
+            for key, blob in blobs.items():
+                self.assertEqual(rfdd[key].as_dict(), {'data': blob, 'size': len(blob)})
+
     
     def test_load_keys(self):
         wfdd_dict = {}
@@ -1306,6 +2005,11 @@ class TestFDD(unittest.TestCase):
                 self.assertIsInstance(k,str)
                 self.assertIn(k,house_keys)
 
+        with RFDD(self.test_file) as rfdd:
+            rfdd.load_keys(row_to_key=lambda x:x.name,filter_function=lambda x:(x.area//10)%2==0, prefetch=7)
+            self.assertEqual(list(rfdd.keys()), [f'house_{i}' for i in range(0,100,2)])
+            self.assertEqual(rfdd['house_4'].area, 140)
+
     def test_filter_string(self):
         wfdd_dict = {}
         with WFDD(self.test_file, columns={'name':'str','area':'any', 'price':'any'}, overwrite=True,) as wfdd:
@@ -1364,6 +2068,12 @@ class TestFDD(unittest.TestCase):
             self.assertEqual(rfdd[12].as_dict(), wfdd_dict['house_25'])
             self.assertEqual(rfdd['house_36'].as_dict(), wfdd_dict['house_36'])
 
+        with RFDD(self.test_file+'^keyless,'+self.test_file2+'^keyless') as rfdd:
+            rfdd.filter(lambda x:x.area >= 600, row_to_key=lambda x:x.name, prefetch=7)
+            self.assertEqual(len(rfdd), 50)
+            self.assertEqual(rfdd['house_62'].as_dict(), wfdd_dict['house_62'])
+            self.assertEqual(rfdd['house_99'].as_dict(), wfdd_dict['house_99'])
+
 
 
     def test_dataloader_integration(self):
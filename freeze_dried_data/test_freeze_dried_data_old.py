@@ -1,6 +1,6 @@
 import os
 import unittest
-from freeze_dried_data.freeze_dried_data import FDD
+from freeze_dried_data.freeze_dried_data_old import FDD, PackedIndex
 import random
 
 
@@ -153,6 +153,97 @@ class TestFDDBase(unittest.TestCase):
             with self.assertRaises(ValueError):
                 fdd.new_custom_property = 'should_fail'
 
+    def test_serializers(self):
+        for serializer in ['pickle', 'pickle5', 'msgpack', (lambda x: repr(x).encode(), lambda x: eval(x.decode()))]:
+            with FDD(self.test_file, write_or_overwrite=True, compression=self.compression_type, serializer=serializer) as fdd:
+                fdd['hello'] = 'world'
+                fdd[('tuple', 'key')] = [1, 2, 3]
+
+            with FDD(self.test_file, compression=self.compression_type, serializer=serializer) as fdd:
+                self.assertEqual(fdd['hello'], 'world')
+                self.assertEqual(fdd[('tuple', 'key')], [1, 2, 3])
+
+        with self.assertRaises(ValueError):
+            FDD(self.test_file, write_or_overwrite=True, serializer='json')
+
+    def test_value_cache(self):
+        with FDD(self.test_file, write_or_overwrite=True, compression=self.compression_type) as fdd:
+            for i in range(5):
+                fdd[f'key{i}'] = [i]
+
+        with FDD(self.test_file, compression=self.compression_type, cache_size=2) as fdd:
+            first = fdd['key0']
+            self.assertIs(fdd['key0'], first)
+            self.assertEqual([fdd[f'key{i}'] for i in range(5)], [[i] for i in range(5)])
+            self.assertEqual(len(fdd._cache), 2)
+            self.assertIsNot(fdd['key0'], first)
+            self.assertEqual(fdd['key0'], first)
+
+    def test_preload(self):
+        with FDD(self.test_file, write_or_overwrite=True, compression=self.compression_type) as fdd:
+            fdd['hello'] = 'world'
+            fdd.custom_property = 'test_value'
+
+        with FDD(self.test_file, compression=self.compression_type, preload=True) as fdd:
+            self.assertIsInstance(fdd._mm, bytes)
+            self.assertEqual(fdd['hello'], 'world')
+            self.assertEqual(fdd.custom_property, 'test_value')
+            fdd._after_fork()
+            self.assertEqual(fdd['hello'], 'world')
+
+    def test_async_write(self):
+        data = {f'key{i}': ('value', i) for i in range(2000)}
+        with FDD(self.test_file, write_or_overwrite=True, compression=self.compression_type, async_write=True) as fdd:
+            fdd.update(data)
+            self.assertEqual(fdd['key1000'], ('value', 1000))
+            fdd['last'] = 'x' * 100000
+            fdd.custom_property = 'test_value'
+
+        with FDD(self.test_file, compression=self.compression_type) as fdd:
+            self.assertEqual(len(fdd), 2001)
+            self.assertEqual(fdd['key1999'], ('value', 1999))
+            self.assertEqual(fdd['last'], 'x' * 100000)
+            self.assertEqual(fdd.custom_property, 'test_value')
+
+    def test_async_write_error(self):
+        # any error in the writer thread, not only OSError, reaches the caller, and closing does not hang
+        def failing_pwrite(fd, data, offset):
+            raise MemoryError()
+        pwrite = os.pwrite
+        os.pwrite = failing_pwrite
+        try:
+            with self.assertRaises(MemoryError):
+                with FDD(self.test_file, write_or_overwrite=True, compression=self.compression_type, async_write=True) as fdd:
+                    for i in range(2000):
+                        fdd[f'key{i}'] = 'x' * 1000
+        finally:
+            os.pwrite = pwrite
+
+    def test_packed_index(self):
+        with FDD(self.test_file, write_or_overwrite=True, compression=self.compression_type) as fdd:
+            fdd['hello'] = 'world'
+            fdd[('tuple', 'key')] = [1, 2, 3]
+            fdd.custom_property = 'test_value'
+
+        with FDD(self.test_file, compression=self.compression_type) as fdd:
+            self.assertIsInstance(fdd.index, PackedIndex)
+            self.assertEqual(list(fdd.keys()), ['hello', ('tuple', 'key')])
+            self.assertEqual(fdd['hello'], 'world')
+            self.assertEqual(fdd[('tuple', 'key')], [1, 2, 3])
+            self.assertEqual(fdd.index['hello'][0], 0)
+            self.assertEqual(fdd.custom_property, 'test_value')
+            self.assertNotIn('missing', fdd)
+            with self.assertRaises(KeyError):
+                fdd['missing']
+
+        # files with a pickled dict index can still be read
+        with FDD(self.test_file, write_or_overwrite=True, compression=self.compression_type) as fdd:
+            fdd['hello'] = 'world'
+            fdd._packed_index_bytes = lambda: None
+        with FDD(self.test_file, compression=self.compression_type) as fdd:
+            self.assertIsInstance(fdd.index, dict)
+            self.assertEqual(fdd['hello'], 'world')
+
 
     def test_dataloader(self):
         from torch.utils.data import DataLoader, Dataset
@@ -193,7 +284,7 @@ def create_compression_test_class(compression_type):
     return type(class_name, (TestFDDBase,), {'compression_type': compression_type})
 
 # Registering test classes for each compression type
-compression_types = ['zlib', 'bz2', 'gzip', 'none', (lambda x: x + b' ', lambda x: x[:-1])]
+compression_types = ['zlib', 'bz2', 'gzip', 'zstd', 'none', (lambda x: x + b' ', lambda x: x[:-1])]
 
 for comp_type in compression_types:
     # Creating and adding to globals to ensure it's picked up by unittest